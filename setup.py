@@ -54,6 +54,8 @@ setup(
     zip_safe=False,
     extras_require={
         'testing': tests_require,
+        'yaml': ['PyYAML'],
+        'speedups': ['orjson', 'brotli'],
     },
     install_requires=requires,
     entry_points={
@@ -64,6 +66,9 @@ setup(
             'initialize_taskmanager_db = taskmanager.scripts.initializedb:main',
             'state_updater = taskmanager.scripts.state_updater:main',
             'task_scheduler = taskmanager.scripts.task_scheduler:main',
+            'task_retention = taskmanager.scripts.retention:main',
+            'task_archiver = taskmanager.scripts.archiver:main',
+            'task_index_report = taskmanager.scripts.index_report:main',
             'tasky = taskmanager.scripts.cli:main',
             'test_run = taskmanager.scripts.test_script_1:main',
             'create_test_data = taskmanager.scripts.create_testdata:main',
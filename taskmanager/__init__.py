@@ -7,6 +7,7 @@ def main(global_config, **settings):
     config = Configurator(settings=settings)
     config.include('pyramid_jinja2')
     config.include('.models')
+    config.include('.renderers')
     config.include('.views.tasks')
     config.include('.views.teams')
     config.include('.views.workers')
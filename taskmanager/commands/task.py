@@ -1,13 +1,23 @@
 # -*- coding:utf-8 -*-
 
 import json as _json
+import os as _os
 import platform as _platform
+import time as _time
+import concurrent.futures as _futures
 
 import requests as _requests
 import click as _click
 
 import taskmanager.models.schemas as _schema
 import taskmanager.commands.base as _base
+import taskmanager.commands.config as _config
+
+# seconds between polls for new output with --follow
+_FOLLOW_INTERVAL = 1
+
+# task fields shown by ``list`` in table format
+_TABLE_FIELDS = ("id", "title", "script", "worker", "scheduled", "run", "state")
 
 _COLORS = {
     "SUCCEED": "green",
@@ -62,15 +72,78 @@ def _get_script_by_name(script_name):
 #     return schema().load(result.json()).data
 
 
-def _get_remote_data(url, schema):
-    url = "{{server}}{url}".format(url=url)
-    result = _base.get_response(url)
-    if not result:
-        return
-    result = result.json()
-    if 'data' in result:
-        result = result.pop("data")
-    return schema().load(result)
+class _RemoteData(object):
+    """ Related resources of a task list, fetched once per URL
+
+    URLs are deduplicated and fetched concurrently over one keep-alive
+    session. With ``cache_ttl`` the responses are also kept on disk for
+    that many seconds, so repeated listings don't fetch them again.
+    """
+    CACHE_FILE = _os.path.expanduser("~/.cache/taskmanager/remote_data.json")
+
+    def __init__(self, jobs=8, cache_ttl=0):
+        self._server = _config.get_config()["server"]
+        self._jobs = jobs
+        self._cache_ttl = cache_ttl
+        self._session = _requests.Session()
+        adapter = _requests.adapters.HTTPAdapter(pool_maxsize=jobs)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        # url -> (fetched, data)
+        self._data = self._read_cache()
+        self._loaded = {}
+
+    def _read_cache(self):
+        if not self._cache_ttl:
+            return {}
+        try:
+            with open(self.CACHE_FILE) as cache_file:
+                cache = _json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+        oldest = _time.time() - self._cache_ttl
+        return {
+            url: (fetched, data)
+            for url, (fetched, data) in cache.items()
+            if fetched > oldest
+        }
+
+    def _write_cache(self):
+        if not self._cache_ttl:
+            return
+        _os.makedirs(_os.path.dirname(self.CACHE_FILE), exist_ok=True)
+        with open(self.CACHE_FILE, "w") as cache_file:
+            _json.dump(self._data, cache_file)
+
+    def _fetch(self, url):
+        response = self._session.get(f"{self._server}{url}", timeout=30)
+        if not response.ok:
+            _click.secho(f"Couldn't get {url}: {response.status_code}", fg="red")
+            return None
+        result = response.json()
+        if "data" in result:
+            result = result.pop("data")
+        return result
+
+    def prefetch(self, urls):
+        """ fetch all urls not known yet, concurrently """
+        missing = sorted({url for url in urls if url and url not in self._data})
+        if not missing:
+            return
+        fetched = _time.time()
+        with _futures.ThreadPoolExecutor(max_workers=self._jobs) as pool:
+            for url, data in zip(missing, pool.map(self._fetch, missing)):
+                if data is not None:
+                    self._data[url] = (fetched, data)
+        self._write_cache()
+
+    def get(self, url, schema):
+        """ loaded resource of url, fetched if it wasn't prefetched """
+        if url not in self._loaded:
+            self.prefetch([url])
+            _fetched, data = self._data.get(url, (None, None))
+            self._loaded[url] = schema().load(data) if data is not None else None
+        return self._loaded[url]
 
 
 @_click.group(short_help="command to get/create/update tasks")
@@ -91,7 +164,10 @@ def task():
 @_click.option("--state", required=False, default="ALL", help="Filter by state")
 @_click.option("--size", required=False, default=100, help="Limit Items in result")
 @_click.option("--page", required=False, default=0, help="Page for the result")
-def list(format, team_id, script_id, worker_id, state, size, page):
+@_click.option("--jobs", default=8, help="Parallel requests for scripts, teams and queues")
+@_click.option("--cache-ttl", default=0, help="Seconds to cache scripts, teams and queues on disk")
+@_click.option("--archive", is_flag=True, help="List archived tasks")
+def list(format, team_id, script_id, worker_id, state, size, page, jobs, cache_ttl, archive):
     params = ["include_data=1"]
     if team_id:
         params.append(f"team={team_id}")
@@ -105,6 +181,13 @@ def list(format, team_id, script_id, worker_id, state, size, page):
         params.append(f"page[size]={size}")
     if page:
         params.append(f"page[number]={page}")
+    if archive:
+        params.append("archive=1")
+    if format == "table":
+        # only the columns of the table, the team column needs the team
+        # of the script side-loaded too
+        params.append(f"fields[tasks]={','.join(_TABLE_FIELDS)}")
+        params.append("include=script,script.team,worker")
 
     url = "{{server}}/tasks?{params}".format(
         params="&".join(params),
@@ -123,10 +206,22 @@ def list(format, team_id, script_id, worker_id, state, size, page):
         result = result.pop("data")
     data = _schema.Tasks(**attrs).load(result)
     if not json_api:
+        remote = _RemoteData(jobs=jobs, cache_ttl=cache_ttl)
+        remote.prefetch(
+            [task["script"] for task in data] + [task["worker"] for task in data]
+        )
         for task in data:
-            task["script"] = _get_remote_data(task["script"], _schema.Script)
-            task["script"]["team"] = _get_remote_data(task["script"]["team"], _schema.Team)
-            task["worker"] = _get_remote_data(task["worker"], _schema.WorkerQueue)
+            task["script"] = remote.get(task["script"], _schema.Script)
+            task["worker"] = remote.get(task["worker"], _schema.WorkerQueue)
+        # tasks of one script share the loaded script
+        scripts = {
+            id(task["script"]): task["script"]
+            for task in data
+            if task["script"]
+        }
+        remote.prefetch([script["team"] for script in scripts.values()])
+        for script in scripts.values():
+            script["team"] = remote.get(script["team"], _schema.Team)
 
     if format == "json":
         _click.echo(_json.dumps(data))
@@ -189,14 +284,116 @@ def list(format, team_id, script_id, worker_id, state, size, page):
             _click.secho(text_formatted, fg=_COLORS[task["state"]])
 
 
+def _resolve_names(items, key, lookup, kind):
+    """ replace queue/script names by ids, each name is looked up once """
+    ids = {}
+    for item in items:
+        name = item[key]
+        if isinstance(name, int):
+            continue
+        if name not in ids:
+            data = lookup(name)
+            if data is None:
+                _click.secho(f"{kind} {name!r} not found.", fg="red")
+                return False
+            ids[name] = data["id"]
+        item[key] = ids[name]
+    return True
+
+
+def _add_from_file(task_file):
+    """ submit all tasks of a JSON file with one request
+
+    The file holds a list of tasks (or ``{"tasks": [...]}``) with
+    ``title``, ``worker`` and ``script`` (names or ids), ``options``,
+    ``parent_id`` and ``depends``. Tasks can be given a ``ref`` name which
+    later tasks use in ``parent_id``/``depends`` instead of an id.
+    """
+    items = _json.load(task_file)
+    if isinstance(items, dict):
+        items = items.get("tasks", [])
+    if not _resolve_names(items, "worker", _get_worker_queue_by_name, "Queue"):
+        return
+    if not _resolve_names(items, "script", _get_script_by_name, "Script"):
+        return
+    for item in items:
+        item.setdefault("scheduledBy", _platform.node())
+
+    result = _base.post_response(
+        "{server}/tasks/batch",
+        data=_json.dumps({"tasks": items}),
+    )
+    if not result:
+        return
+    for task_id in result.json()["data"]["ids"]:
+        _click.secho("{}".format(task_id), fg="green")
+
+
+def _load_workflow(workflow_file):
+    """ nodes of a JSON or YAML workflow file as a list with ``ref`` set
+
+    ``nodes`` is either a mapping of node name to task or a list of tasks
+    with a ``ref``.
+    """
+    if workflow_file.name.endswith((".yaml", ".yml")):
+        try:
+            import yaml as _yaml
+        except ImportError:
+            raise _click.ClickException(
+                "YAML workflows need PyYAML (pip install taskmanager[yaml])"
+            )
+        workflow = _yaml.safe_load(workflow_file)
+    else:
+        workflow = _json.load(workflow_file)
+    nodes = workflow.get("nodes", []) if isinstance(workflow, dict) else workflow
+    if isinstance(nodes, dict):
+        nodes = [dict(node, ref=ref) for ref, node in nodes.items()]
+    return nodes
+
+
+@task.command(short_help="submit a workflow of dependent tasks")
+@_click.argument("workflow_file", type=_click.File())
+def workflow(workflow_file):
+    """ Create all tasks of a JSON/YAML workflow in one transaction
+
+    Nodes name each other in ``parent_id`` and ``depends``, in any order.
+    Cycles and unknown names are rejected by the server and nothing is
+    created.
+    """
+    nodes = _load_workflow(workflow_file)
+    if not _resolve_names(nodes, "worker", _get_worker_queue_by_name, "Queue"):
+        return
+    if not _resolve_names(nodes, "script", _get_script_by_name, "Script"):
+        return
+    for node in nodes:
+        node.setdefault("scheduledBy", _platform.node())
+
+    result = _base.post_response(
+        "{server}/tasks/workflow",
+        data=_json.dumps({"nodes": nodes}),
+    )
+    if not result:
+        return
+    for ref, task_id in result.json()["data"]["ids"].items():
+        _click.echo("{}: ".format(ref), nl=False)
+        _click.secho("{}".format(task_id), fg="green")
+
+
 @task.command(short_help="add new task")
-@_click.argument("title")
-@_click.argument("worker")
-@_click.argument("script")
+@_click.argument("title", required=False)
+@_click.argument("worker", required=False)
+@_click.argument("script", required=False)
 @_click.option("--option", multiple=True, nargs=2, type=_click.Tuple([str, str]), required=False)
 @_click.option("--parent", type=int, required=False)
 @_click.option("--depend", type=int, multiple=True, help="Task depending on Task ids", required=False)
-def add(title, worker, script, option, parent, depend):
+@_click.option("--from-file", type=_click.File(), required=False, help="Add all tasks of a JSON file at once")
+def add(title, worker, script, option, parent, depend, from_file):
+    if from_file:
+        _add_from_file(from_file)
+        return
+    if not (title and worker and script):
+        raise _click.UsageError("TITLE, WORKER and SCRIPT are required")
+
     worker_queue = _get_worker_queue_by_name(worker)
     if worker_queue is None:
         _click.secho(
@@ -249,16 +446,116 @@ def add(title, worker, script, option, parent, depend):
 
 @task.command(short_help="Get result for task")
 @_click.argument("task_id")
-def result(task_id):
-    result = _base.get_response(
-        "{{server}}/tasks/{task_id}/result".format(
-            task_id=task_id,
+@_click.option("--wait", is_flag=True, help="Wait until the task finished")
+def result(task_id, wait):
+    while True:
+        result = _base.get_response(
+            "{{server}}/tasks/{task_id}/result{params}".format(
+                task_id=task_id,
+                params="?wait=60" if wait else "",
+            )
         )
-    )
-    if not result:
+        if not result:
+            return
+        data = result.json()["data"]
+        if data["ready"] or not wait:
+            break
+        if result.status_code == 202:
+            # too many clients waiting, the server didn't wait
+            _time.sleep(int(result.headers.get("Retry-After", 5)))
+
+    if not data["ready"]:
+        _click.echo("State: {state}".format(**data))
         return
-    result = result.json()
-    data = result["data"]
     _click.echo("Result Code: {return_code}".format(**data))
     _click.secho("Stdout: {stdout}".format(**data), fg="green")
     _click.secho("Stderr: {stderr}".format(**data), fg="red")
+
+
+@task.command(short_help="Show output of a task")
+@_click.argument("task_id")
+@_click.option(
+    "--stream",
+    type=_click.Choice(["stdout", "stderr"]),
+    default="stdout",
+    help="Output stream to show (default: stdout)"
+)
+@_click.option("--attempt", type=int, required=False, help="Run attempt (default: latest)")
+@_click.option("--tail", type=int, required=False, help="Show only the last bytes")
+@_click.option("--follow", is_flag=True, help="Keep showing new output until the task finished")
+def logs(task_id, stream, attempt, tail, follow):
+    params = [f"stream={stream}"]
+    if attempt is not None:
+        params.append(f"attempt={attempt}")
+    if tail:
+        params.append(f"tail={tail}")
+    offset = None
+    while True:
+        url_params = params if offset is None else params + [f"offset={offset}"]
+        result = _base.get_response(
+            "{{server}}/tasks/{task_id}/output?{params}".format(
+                task_id=task_id,
+                params="&".join(url_params),
+            )
+        )
+        if not result:
+            return
+        data = result.json()["data"]
+        if attempt is None and data["attempt"] is not None:
+            # stay with this run, even if a retry starts meanwhile
+            attempt = data["attempt"]
+            params.append(f"attempt={attempt}")
+        if offset is None and tail:
+            params.remove(f"tail={tail}")
+        _click.echo(data["output"], nl=False)
+        offset = data["offset"] + data["length"]
+        if data["length"] and offset < data["size"]:
+            continue
+        if not follow or not data["running"]:
+            break
+        _time.sleep(_FOLLOW_INTERVAL)
+
+
+@task.command(short_help="Export tasks as NDJSON or CSV")
+@_click.option(
+    "--format",
+    type=_click.Choice(["ndjson", "csv"]),
+    default="ndjson",
+    help="Select output format (default: ndjson)"
+)
+@_click.option("--team_id", required=False, help="Filter by team id")
+@_click.option("--script", required=False, help="Filter by script names (comma separated)")
+@_click.option("--worker_id", required=False, help="Filter by worker ids (comma separated)")
+@_click.option("--state", required=False, default="ALL", help="Filter by state")
+@_click.option("--scheduled-from", required=False, help="Scheduled at or after (ISO 8601)")
+@_click.option("--scheduled-to", required=False, help="Scheduled before (ISO 8601)")
+@_click.option("--run-from", required=False, help="Run at or after (ISO 8601)")
+@_click.option("--run-to", required=False, help="Run before (ISO 8601)")
+@_click.option("--output", type=_click.File("wb"), default="-", help="File to write to (default: stdout)")
+def export(format, team_id, script, worker_id, state, scheduled_from, scheduled_to, run_from, run_to, output):
+    """ Stream all matching tasks, without paging """
+    params = {
+        "format": format,
+        "state": state,
+        "team": team_id,
+        "script": script,
+        "worker": worker_id,
+        "scheduled_from": scheduled_from,
+        "scheduled_to": scheduled_to,
+        "run_from": run_from,
+        "run_to": run_to,
+    }
+    response = _requests.get(
+        "{server}/tasks/export".format(server=_config.get_config()["server"]),
+        params={key: value for key, value in params.items() if value},
+        stream=True,
+    )
+    if not response.ok:
+        _click.secho(
+            "Export failed: {} {}".format(response.status_code, response.text),
+            fg="red",
+        )
+        return
+    with response:
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            output.write(chunk)
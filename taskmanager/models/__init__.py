@@ -1,5 +1,8 @@
 from sqlalchemy import engine_from_config
+from sqlalchemy import func
+from sqlalchemy import text
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.util import asbool
 from sqlalchemy.orm import configure_mappers
 import zope.sqlalchemy
 
@@ -13,7 +16,12 @@ from taskmanager.models.taskmanager import (
     Task,
     TaskLog,
     TaskDepends,
-    association_table
+    TaskArchive,
+    TaskLogArchive,
+    TaskCounter,
+    TableVersion,
+    association_table,
+    archive_dependencies,
 )  # flake8: noqa
 
 # run configure_mappers after defining all of the models to ensure
@@ -22,7 +30,203 @@ configure_mappers()
 
 
 def get_engine(settings, prefix='sqlalchemy.'):
-    return engine_from_config(settings, prefix)
+    """
+    Create an engine from the ``sqlalchemy.*`` settings.
+
+    Pool options (``pool_size``, ``max_overflow``, ``pool_recycle``,
+    ``pool_timeout``) are coerced by SQLAlchemy itself, ``pool_pre_ping``
+    is not, so it is converted here and enabled by default to survive
+    connections dropped by the database or a proxy in between.
+
+    """
+    settings = dict(settings)
+    pre_ping = settings.pop(prefix + 'pool_pre_ping', True)
+    return engine_from_config(
+        settings,
+        prefix,
+        pool_pre_ping=asbool(pre_ping),
+    )
+
+
+# channel used to wake up the task scheduler, see ``notify_scheduler``
+SCHEDULER_CHANNEL = 'taskmanager_scheduler'
+
+
+# events sent to the scheduler, the payload is ``<event>:<key>``
+NOTIFY_CREATED = 'created'  # key: comma separated task ids
+NOTIFY_SUCCEED = 'SUCCEED'  # key: task id
+NOTIFY_FAILED = 'FAILED'  # key: task id
+NOTIFY_QUEUE = 'queue'  # key: queue name
+
+
+def notify_scheduler(dbsession, event, key=''):
+    """
+    Wake up the task scheduler once the current transaction commits.
+
+    PostgreSQL delivers ``NOTIFY`` only on commit (and folds duplicates
+    within one transaction), so this can be called for every change that
+    might make a task ready. Other databases don't support it, the
+    scheduler falls back to polling there.
+
+    """
+    if dbsession.bind.dialect.name != 'postgresql':
+        return
+    dbsession.execute(
+        text('SELECT pg_notify(:channel, :payload)'),
+        {'channel': SCHEDULER_CHANNEL, 'payload': f'{event}:{key}'},
+    )
+
+
+def parse_notify(payload):
+    """ Split a scheduler notification payload into ``(event, key)`` """
+    event, _, key = payload.partition(':')
+    return event, key
+
+
+# advisory lock keys, only one process reconciles or compacts at a time
+_RECONCILE_LOCK = 0x7461736b
+_COMPACT_LOCK = 0x7461736c
+_COMPACT_COUNTERS_LOCK = 0x7461736d
+
+_COUNTER_DRIFT = """
+INSERT INTO task_counter_deltas (state, worker_id, team_id, count)
+SELECT state, worker_id, team_id, sum(count)
+FROM (
+    SELECT
+        COALESCE(tasks.state, '') AS state,
+        COALESCE(tasks.worker_id, 0) AS worker_id,
+        COALESCE(scripts.team_id, 0) AS team_id,
+        count(1) AS count
+    FROM
+        tasks
+    LEFT JOIN
+        scripts ON scripts.id = tasks.script_id
+    GROUP BY
+        1, 2, 3
+    UNION ALL
+    SELECT state, worker_id, team_id, -sum(count)
+    FROM task_counter_deltas
+    GROUP BY 1, 2, 3
+) counts
+GROUP BY
+    1, 2, 3
+HAVING
+    sum(count) <> 0
+"""
+
+_COUNTER_COMPACT = """
+WITH deleted AS (
+    DELETE FROM task_counter_deltas
+    RETURNING state, worker_id, team_id, count
+)
+INSERT INTO task_counter_deltas (state, worker_id, team_id, count)
+SELECT state, worker_id, team_id, sum(count)
+FROM deleted
+GROUP BY 1, 2, 3
+HAVING sum(count) <> 0
+"""
+
+
+def reconcile_task_counters(engine):
+    """
+    Repair drift of the task counters against ``tasks``.
+
+    The triggers keep the counters exact, this only repairs drift
+    (scripts moved between teams, counters of a restored dump). Tasks
+    and counters are compared in one snapshot, the difference is
+    inserted as correction rows. Nothing is locked, the triggers only
+    insert rows too, so writers of ``tasks`` aren't blocked by the scan.
+    Skipped while another process reconciles.
+
+    Returns:
+        bool: False if skipped
+    """
+    if engine.dialect.name != 'postgresql':
+        return False
+    with engine.connect() as connection:
+        connection = connection.execution_options(
+            isolation_level='REPEATABLE READ'
+        )
+        with connection.begin():
+            if not connection.execute(
+                text('SELECT pg_try_advisory_xact_lock(:key)'),
+                {'key': _RECONCILE_LOCK},
+            ).scalar():
+                return False
+            connection.execute(text(_COUNTER_DRIFT))
+    return True
+
+
+def compact_task_counters(engine):
+    """
+    Fold the task counter rows into one per (state, queue, team).
+
+    Skipped while another process compacts.
+
+    Returns:
+        bool: False if skipped
+    """
+    if engine.dialect.name != 'postgresql':
+        return False
+    with engine.begin() as connection:
+        if not connection.execute(
+            text('SELECT pg_try_advisory_xact_lock(:key)'),
+            {'key': _COMPACT_COUNTERS_LOCK},
+        ).scalar():
+            return False
+        connection.execute(text(_COUNTER_COMPACT))
+    return True
+
+
+def table_versions(dbsession, tables):
+    """
+    Current change versions of ``tables``, in the given order.
+
+    Returns None on databases without the version triggers (anything but
+    PostgreSQL), callers can't tell changes apart there.
+
+    """
+    if dbsession.bind.dialect.name != 'postgresql':
+        return None
+    versions = dict(
+        dbsession.query(
+            TableVersion.name,
+            func.sum(TableVersion.count),
+        ).filter(
+            TableVersion.name.in_(tables)
+        ).group_by(
+            TableVersion.name
+        )
+    )
+    return tuple(int(versions.get(table, 0)) for table in tables)
+
+
+def compact_table_versions(engine):
+    """
+    Fold the ``table_version_deltas`` rows into one per table.
+
+    The sum per table, the version, doesn't change. Skipped while
+    another process compacts.
+
+    Returns:
+        bool: False if skipped
+    """
+    if engine.dialect.name != 'postgresql':
+        return False
+    with engine.begin() as connection:
+        if not connection.execute(
+            text('SELECT pg_try_advisory_xact_lock(:key)'),
+            {'key': _COMPACT_LOCK},
+        ).scalar():
+            return False
+        connection.execute(text("""
+            WITH deleted AS (
+                DELETE FROM table_version_deltas RETURNING name, count
+            )
+            INSERT INTO table_version_deltas (name, count)
+            SELECT name, sum(count) FROM deleted GROUP BY name
+        """))
+    return True
 
 
 def get_session_factory(engine):
@@ -76,7 +280,11 @@ def includeme(config):
     # use pyramid_retry to retry a request when transient exceptions occur
     config.include('pyramid_retry')
 
-    session_factory = get_session_factory(get_engine(settings))
+    # one engine (and with it one connection pool) per process, every
+    # request borrows a connection from it instead of connecting on its own
+    engine = get_engine(settings)
+    session_factory = get_session_factory(engine)
+    config.registry['dbsession_engine'] = engine
     config.registry['dbsession_factory'] = session_factory
 
     # make request.dbsession available for use in Pyramid
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Move finished tasks with their logs and dependencies to the archive
+tables (``tasks_archive``, ``task_log_archive``,
+``task_dependencies_archive``), keeping the hot tables small.
+"""
+
+import logging as _logging
+
+from sqlalchemy import text
+
+_log = _logging.getLogger(__name__)
+
+FINISHED = ('SUCCEED', 'FAILED-ACKED', 'DELETED')
+
+_TASK_COLUMNS = (
+    'id, script_id, worker_id, scheduled, title, run, state, locks, '
+    'options, scheduled_by, parent_id'
+)
+
+
+def _archivable(ids, references):
+    """ drop tasks still referenced by tasks which are not archived with
+    them, until no such reference is left
+
+    ``references`` are (target, source) pairs, source being a child or
+    dependent of target.
+    """
+    ids = set(ids)
+    while True:
+        blocked = {
+            target
+            for target, source in references
+            if target in ids and source not in ids
+        }
+        if not blocked:
+            return ids
+        ids -= blocked
+
+
+def archive_tasks(connection, before, batch_size=1000):
+    """
+    Archive up to ``batch_size`` finished tasks scheduled before ``before``.
+
+    Tasks which are still parent or dependency of a task staying in
+    ``tasks`` are skipped. The newest are archived first, so children and
+    dependents go before the tasks they refer to.
+
+    The tasks are locked (FOR UPDATE) before their logs and dependencies
+    are copied and deleted, the order writers of tasks lock in.
+
+    Returns:
+        int: number of archived tasks, 0 if nothing (more) can be archived
+    """
+    candidates = [
+        task_id
+        for task_id, in connection.execute(text("""
+            SELECT id FROM tasks
+            WHERE state IN :states AND scheduled < :before
+            AND NOT EXISTS (
+                SELECT 1 FROM tasks child
+                WHERE child.parent_id = tasks.id
+                AND NOT (child.state IN :states AND child.scheduled < :before)
+            )
+            AND NOT EXISTS (
+                SELECT 1 FROM task_dependencies
+                JOIN tasks dependent ON dependent.id = task_dependencies.task_id
+                WHERE task_dependencies.depend_id = tasks.id
+                AND NOT (
+                    dependent.state IN :states AND dependent.scheduled < :before
+                )
+            )
+            ORDER BY id DESC
+            LIMIT :limit
+            FOR UPDATE SKIP LOCKED
+        """), {'states': FINISHED, 'before': before, 'limit': batch_size})
+    ]
+    if not candidates:
+        return 0
+    references = connection.execute(text("""
+        SELECT parent_id, id FROM tasks WHERE parent_id IN :ids
+        UNION ALL
+        SELECT depend_id, task_id FROM task_dependencies
+        WHERE depend_id IN :ids
+    """), {'ids': tuple(candidates)}).fetchall()
+    ids = _archivable(candidates, references)
+    if not ids:
+        return 0
+    connection.execute(text(f"""
+        INSERT INTO tasks_archive ({_TASK_COLUMNS})
+        SELECT {_TASK_COLUMNS} FROM tasks WHERE id IN :ids;
+        INSERT INTO task_log_archive (id, task_id, run, state, worker_id)
+        SELECT id, task_id, run, state, worker_id FROM task_log
+        WHERE task_id IN :ids;
+        INSERT INTO task_dependencies_archive (task_id, depend_id)
+        SELECT task_id, depend_id FROM task_dependencies
+        WHERE task_id IN :ids;
+        DELETE FROM task_log WHERE task_id IN :ids;
+        DELETE FROM task_dependencies WHERE task_id IN :ids;
+        DELETE FROM tasks WHERE id IN :ids
+    """), {'ids': tuple(ids)})
+    return len(ids)
+
+
+def delete_archived_tasks(connection, before, batch_size=1000):
+    """
+    Delete up to ``batch_size`` archived tasks scheduled before ``before``.
+
+    Returns:
+        int: number of deleted tasks, call again until it is 0
+    """
+    ids = [
+        task_id
+        for task_id, in connection.execute(text("""
+            SELECT id FROM tasks_archive
+            WHERE scheduled < :before
+            ORDER BY id
+            LIMIT :limit
+        """), {'before': before, 'limit': batch_size})
+    ]
+    if not ids:
+        return 0
+    connection.execute(text("""
+        DELETE FROM task_log_archive WHERE task_id IN :ids;
+        DELETE FROM task_dependencies_archive WHERE task_id IN :ids;
+        DELETE FROM tasks_archive WHERE id IN :ids
+    """), {'ids': tuple(ids)})
+    return len(ids)
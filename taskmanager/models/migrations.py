@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Schema changes ``create_all`` can't do, applied once and in order by
+``initializedb`` (PostgreSQL only).
+
+Applied migrations are recorded in ``schema_migrations``. Append new
+ones to ``MIGRATIONS``, never change or reorder applied ones.
+"""
+
+import logging as _logging
+import re as _re
+
+from sqlalchemy import text
+
+from . import partitions as _partitions
+
+_log = _logging.getLogger(__name__)
+
+# (name, statement, concurrent): concurrent statements are CREATE INDEX
+# CONCURRENTLY, run outside of a transaction, so building an index
+# doesn't block writers of the table
+MIGRATIONS = (
+    (
+        '0001_tasks_prerun',
+        # pending tasks of the scheduler (``_pending_tasks``)
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tasks_prerun "
+        "ON tasks (id) WHERE state = 'PRERUN' AND run IS NULL",
+        True,
+    ),
+    (
+        '0002_tasks_failed_run',
+        # restarts of failed tasks (``_handle_failed_tasks``)
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tasks_failed_run "
+        "ON tasks (run) WHERE state = 'FAILED'",
+        True,
+    ),
+    (
+        '0003_tasks_state_id',
+        # list pages filtered by state
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tasks_state_id "
+        "ON tasks (state, id DESC)",
+        True,
+    ),
+    (
+        '0004_tasks_script_id_id',
+        # list pages filtered by script or team
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tasks_script_id_id "
+        "ON tasks (script_id, id DESC)",
+        True,
+    ),
+    (
+        '0005_task_log_task_id_run',
+        # logs of a task, task_log is partitioned: built per partition,
+        # see ``_create_index``
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_task_log_task_id_run "
+        "ON task_log (task_id, run)",
+        True,
+    ),
+    (
+        '0006_task_dependencies_depend_id',
+        # reverse lookups: tasks waiting for a task
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+        "ix_task_dependencies_depend_id ON task_dependencies (depend_id)",
+        True,
+    ),
+)
+
+_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    name TEXT PRIMARY KEY,
+    applied TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()
+)
+"""
+
+
+_CONCURRENT_INDEX = _re.compile(
+    r"CREATE INDEX CONCURRENTLY IF NOT EXISTS (\w+) ON (\w+) (.*)",
+    _re.DOTALL,
+)
+
+
+def _index_name(statement):
+    return statement.split(' IF NOT EXISTS ')[1].split()[0]
+
+
+def index_names():
+    """ names of the indexes created by the migrations """
+    return [
+        _index_name(statement)
+        for _name, statement, _concurrent in MIGRATIONS
+        if ' INDEX ' in statement
+    ]
+
+
+def applied(connection):
+    """ names of the migrations applied so far """
+    if connection.execute(
+        text("SELECT to_regclass('schema_migrations')")
+    ).scalar() is None:
+        return set()
+    return {
+        name
+        for name, in connection.execute(text("SELECT name FROM schema_migrations"))
+    }
+
+
+def _drop_invalid(engine, name):
+    with engine.begin() as connection:
+        invalid = connection.execute(text("""
+            SELECT 1 FROM pg_index
+            WHERE indexrelid = to_regclass(:name) AND NOT indisvalid
+        """), {'name': name}).scalar()
+        if invalid:
+            _log.warning("Dropping invalid index %s", name)
+            connection.execute(text(f"DROP INDEX {name}"))
+
+
+def _execute_autocommit(engine, statement):
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        connection.execute(text(statement))
+
+
+def _create_index(engine, statement):
+    """ run a CREATE INDEX CONCURRENTLY statement
+
+    Partitioned tables can't be indexed concurrently: the index is
+    created invalid ON ONLY the parent, built concurrently on every
+    partition and attached, the parent index gets valid with the last
+    one. Partitions created later get the index from the parent.
+    """
+    name, table, definition = _CONCURRENT_INDEX.match(statement).groups()
+    with engine.connect() as connection:
+        kind = _partitions._kind(connection, table)
+        children = [
+            child
+            for child, _upper in _partitions.partitions(connection)
+        ] if kind == 'p' else []
+    if kind != 'p':
+        # an interrupted concurrent build leaves an invalid index
+        # behind, IF NOT EXISTS would keep it
+        _drop_invalid(engine, name)
+        _execute_autocommit(engine, statement)
+        return
+    with engine.begin() as connection:
+        connection.execute(text(
+            f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} {definition}"
+        ))
+    for child in children:
+        # ix_task_log_task_id_run -> ix_task_log_y2026m01_task_id_run
+        child_name = name.replace(table, child, 1)
+        _drop_invalid(engine, child_name)
+        _execute_autocommit(
+            engine,
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {child_name} "
+            f"ON {child} {definition}",
+        )
+        with engine.begin() as connection:
+            connection.execute(text(
+                f"ALTER INDEX {name} ATTACH PARTITION {child_name}"
+            ))
+
+
+def migrate(engine):
+    """
+    Apply all pending migrations.
+
+    Returns:
+        list: names of the applied migrations
+    """
+    if engine.dialect.name != 'postgresql':
+        return []
+    with engine.begin() as connection:
+        connection.execute(text(_CREATE_TABLE))
+        done = applied(connection)
+    result = []
+    for name, statement, concurrent in MIGRATIONS:
+        if name in done:
+            continue
+        _log.info("Applying migration %s", name)
+        if concurrent:
+            _create_index(engine, statement)
+        with engine.begin() as connection:
+            if not concurrent:
+                connection.execute(text(statement))
+            connection.execute(
+                text("INSERT INTO schema_migrations (name) VALUES (:name)"),
+                {'name': name},
+            )
+        result.append(name)
+    return result
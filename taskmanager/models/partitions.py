@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Monthly range partitions of ``task_log`` by ``run`` (PostgreSQL only).
+
+``tasks`` stays one table: its id is referenced by foreign keys (parent,
+dependencies, logs) and PostgreSQL requires the partition key in every
+unique key of a partitioned table. Old finished tasks are removed by
+``delete_finished_tasks`` instead.
+"""
+
+import datetime as _dt
+import logging as _logging
+import re as _re
+
+from sqlalchemy import text
+
+from .meta import Base
+
+_log = _logging.getLogger(__name__)
+
+TABLE = 'task_log'
+LEGACY = 'task_log_legacy'
+DEFAULT = 'task_log_default'
+FINISHED = ('SUCCEED', 'FAILED-ACKED', 'DELETED')
+
+_CREATE_PARENT = """
+CREATE SEQUENCE IF NOT EXISTS task_log_id_seq;
+CREATE TABLE task_log (
+    id BIGINT NOT NULL DEFAULT nextval('task_log_id_seq'),
+    task_id BIGINT,
+    run TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+    state TEXT,
+    worker_id INTEGER,
+    CONSTRAINT pk_task_log PRIMARY KEY (id, run),
+    CONSTRAINT fk_task_log_task_id_tasks
+        FOREIGN KEY (task_id) REFERENCES tasks (id),
+    CONSTRAINT fk_task_log_worker_id_workers
+        FOREIGN KEY (worker_id) REFERENCES workers (id)
+) PARTITION BY RANGE (run);
+CREATE TABLE task_log_default PARTITION OF task_log DEFAULT
+"""
+
+_RENAME_LEGACY = """
+ALTER TABLE task_log RENAME TO task_log_legacy;
+ALTER TABLE task_log_legacy RENAME CONSTRAINT pk_task_log TO pk_task_log_legacy;
+ALTER TABLE task_log_legacy
+    DROP CONSTRAINT IF EXISTS fk_task_log_task_id_tasks,
+    DROP CONSTRAINT IF EXISTS fk_task_log_worker_id_workers;
+DROP TRIGGER IF EXISTS table_versions_bump ON task_log_legacy;
+ALTER TABLE task_log_legacy ALTER id DROP DEFAULT;
+ALTER SEQUENCE task_log_id_seq OWNED BY NONE
+"""
+
+_BOUND = _re.compile(r"TO \('([^']+)'\)")
+_LOWER = _re.compile(r"FROM \('([^']+)'\)")
+
+
+def month_start(day):
+    return _dt.datetime(day.year, day.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return _dt.datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'{TABLE}_y{month.year}m{month.month:02d}'
+
+
+def _kind(connection, table):
+    """ relkind of table: 'r' table, 'p' partitioned, None if missing """
+    return connection.execute(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"),
+        {'table': table},
+    ).scalar()
+
+
+def _create_dependencies(connection):
+    """ create the tables task_log refers to, without task_log itself
+
+    ``create_all`` can't be used, it also runs the DDL (triggers) that
+    needs task_log to exist.
+    """
+    for table in Base.metadata.sorted_tables:
+        if table.name != TABLE:
+            table.create(connection, checkfirst=True)
+
+
+def setup(engine, months_ahead=2):
+    """
+    Create ``task_log`` as partitioned table or convert an existing one.
+
+    An existing table is attached as partition ``task_log_legacy`` for
+    everything before the current month, nothing is copied. Logs without
+    run time get the scheduled time of their task, logs of the current
+    month and later are moved to the new partitions. Run this before
+    ``Base.metadata.create_all``.
+
+    """
+    if engine.dialect.name != 'postgresql':
+        return
+    with engine.begin() as connection:
+        kind = _kind(connection, TABLE)
+        if kind == 'p':
+            ensure_partitions(connection, months_ahead)
+            return
+        _create_dependencies(connection)
+        if kind == 'r':
+            _log.info("Converting %s into a partitioned table", TABLE)
+            connection.execute(text(_RENAME_LEGACY))
+        connection.execute(text(_CREATE_PARENT))
+        ensure_partitions(connection, months_ahead)
+        if kind == 'r':
+            bound = month_start(_dt.datetime.utcnow())
+            connection.execute(text(f"""
+                UPDATE {LEGACY} SET run = COALESCE(
+                    (SELECT scheduled FROM tasks WHERE tasks.id = task_id),
+                    now()
+                )
+                WHERE run IS NULL;
+                INSERT INTO {TABLE} (id, task_id, run, state, worker_id)
+                SELECT id, task_id, run, state, worker_id
+                FROM {LEGACY}
+                WHERE run >= :bound;
+                DELETE FROM {LEGACY} WHERE run >= :bound;
+                ALTER TABLE {LEGACY} ALTER run SET NOT NULL;
+                ALTER TABLE {TABLE} ATTACH PARTITION {LEGACY}
+                    FOR VALUES FROM (MINVALUE) TO ('{bound.isoformat()}')
+            """), {'bound': bound})
+
+
+def _ranges(connection):
+    """ (lower, upper) of the range partitions, None for MINVALUE """
+    rows = connection.execute(text("""
+        SELECT pg_get_expr(child.relpartbound, child.oid)
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = to_regclass(:table)
+    """), {'table': TABLE})
+    result = []
+    for bound, in rows:
+        upper = _BOUND.search(bound)
+        if upper is None:
+            continue  # DEFAULT
+        lower = _LOWER.search(bound)
+        result.append((
+            _dt.datetime.fromisoformat(lower.group(1)) if lower else None,
+            _dt.datetime.fromisoformat(upper.group(1)),
+        ))
+    return result
+
+
+def _create_partition(connection, month):
+    """ create the partition of month, taking its logs over from the
+    default partition
+    """
+    name = partition_name(month)
+    params = {'lower': month, 'upper': add_months(month, 1)}
+    misplaced = connection.execute(text(f"""
+        SELECT EXISTS (
+            SELECT 1 FROM {DEFAULT}
+            WHERE run >= :lower AND run < :upper
+        )
+    """), params).scalar()
+    bounds = (
+        f"FOR VALUES FROM ('{month.isoformat()}') "
+        f"TO ('{add_months(month, 1).isoformat()}')"
+    )
+    if not misplaced:
+        connection.execute(text(f"CREATE TABLE {name} PARTITION OF {TABLE} {bounds}"))
+        return
+    # the default partition mustn't hold rows of a new partition
+    connection.execute(text(f"""
+        CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS);
+        INSERT INTO {name}
+        SELECT * FROM {DEFAULT} WHERE run >= :lower AND run < :upper;
+        DELETE FROM {DEFAULT} WHERE run >= :lower AND run < :upper;
+        ALTER TABLE {TABLE} ATTACH PARTITION {name} {bounds}
+    """), params)
+
+
+def ensure_partitions(connection, months_ahead=2):
+    """ create the monthly partitions up to ``months_ahead`` months ahead
+
+    Starts at the current month, months covered by existing partitions
+    (e.g. ``task_log_legacy``) are skipped.
+    """
+    current = month_start(_dt.datetime.utcnow())
+    ranges = _ranges(connection)
+    month = current
+    while month <= add_months(current, months_ahead):
+        end = add_months(month, 1)
+        covered = any(
+            (lower is None or lower < end) and upper > month
+            for lower, upper in ranges
+        )
+        if not covered:
+            _create_partition(connection, month)
+            _log.info("Created partition %s", partition_name(month))
+        month = end
+
+
+def partitions(connection):
+    """ partitions of task_log with their upper bound (None for DEFAULT) """
+    rows = connection.execute(text("""
+        SELECT
+            child.relname, pg_get_expr(child.relpartbound, child.oid)
+        FROM
+            pg_inherits
+        JOIN
+            pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE
+            pg_inherits.inhparent = to_regclass(:table)
+        ORDER BY
+            1
+    """), {'table': TABLE})
+    result = []
+    for name, bound in rows:
+        match = _BOUND.search(bound)
+        upper = _dt.datetime.fromisoformat(match.group(1)) if match else None
+        result.append((name, upper))
+    return result
+
+
+def drop_partitions(connection, before, detach_only=False):
+    """
+    Remove the partitions holding only logs older than ``before`` and
+    such logs from the default partition.
+
+    With ``detach_only`` the tables are kept outside of ``task_log``
+    (e.g. to be dumped and dropped later).
+
+    Returns:
+        list: names of the removed partitions
+    """
+    removed = []
+    # logs of months without partition
+    connection.execute(
+        text(f"DELETE FROM {DEFAULT} WHERE run < :before"),
+        {'before': before},
+    )
+    for name, upper in partitions(connection):
+        if upper is None or upper > before:
+            continue
+        connection.execute(text(f"ALTER TABLE {TABLE} DETACH PARTITION {name}"))
+        if not detach_only:
+            connection.execute(text(f"DROP TABLE {name}"))
+        removed.append(name)
+        _log.info("%s partition %s", "Detached" if detach_only else "Dropped", name)
+    return removed
+
+
+def delete_finished_tasks(connection, before, batch_size=1000):
+    """
+    Delete up to ``batch_size`` finished tasks scheduled before ``before``.
+
+    Tasks still parent or dependency of an unfinished task are kept, the
+    scheduler would run that task otherwise. Their logs and dependencies
+    go with them, finished children lose the parent.
+
+    The tasks are locked first, like writers of tasks do, before their
+    logs and dependencies are touched.
+
+    Returns:
+        int: number of deleted tasks, call again until it is 0
+    """
+    ids = [
+        task_id
+        for task_id, in connection.execute(text("""
+            SELECT id FROM tasks
+            WHERE state IN :states AND scheduled < :before
+            AND NOT EXISTS (
+                SELECT 1 FROM tasks child
+                WHERE child.parent_id = tasks.id
+                AND child.state NOT IN :states
+            )
+            AND NOT EXISTS (
+                SELECT 1 FROM task_dependencies
+                JOIN tasks dependent ON dependent.id = task_dependencies.task_id
+                WHERE task_dependencies.depend_id = tasks.id
+                AND dependent.state NOT IN :states
+            )
+            ORDER BY id
+            LIMIT :limit
+            FOR UPDATE SKIP LOCKED
+        """), {'states': FINISHED, 'before': before, 'limit': batch_size})
+    ]
+    if not ids:
+        return 0
+    params = {'ids': tuple(ids)}
+    connection.execute(text("""
+        UPDATE tasks SET parent_id = NULL WHERE parent_id IN :ids;
+        DELETE FROM task_log WHERE task_id IN :ids;
+        DELETE FROM task_dependencies
+        WHERE task_id IN :ids OR depend_id IN :ids;
+        DELETE FROM tasks WHERE id IN :ids
+    """), params)
+    return len(ids)
@@ -187,6 +187,43 @@ class Tasks(Schema):
         strict = True
 
 
+class TaskBatchItem(SimpleSchema):
+    ref = _mm_fields.Str(allow_none=True)
+    title = _mm_fields.Str(missing="")
+    worker = _mm_fields.Integer(required=True)
+    script = _mm_fields.Integer(required=True)
+    options = _mm_fields.Dict(missing=dict)
+    parent_id = _mm_fields.Raw(allow_none=True)
+    depends = _mm_fields.List(_mm_fields.Raw(), missing=list)
+    use_default_opt = _mm_fields.Boolean(missing=False)
+    scheduled_by = _mm_fields.Str(
+        load_from="scheduledBy",
+        dump_to="scheduledBy",
+        missing="",
+    )
+
+    class Meta:
+        strict = True
+
+
+class TaskBatch(SimpleSchema):
+    tasks = _mm_fields.Nested(TaskBatchItem, many=True, required=True)
+
+    class Meta:
+        strict = True
+
+
+class TaskWorkflowNode(TaskBatchItem):
+    ref = _mm_fields.Str(required=True)
+
+
+class TaskWorkflow(SimpleSchema):
+    nodes = _mm_fields.Nested(TaskWorkflowNode, many=True, required=True)
+
+    class Meta:
+        strict = True
+
+
 class TaskLog(Schema):
     id = _fields.Integer()
     task_id = _fields.Integer()
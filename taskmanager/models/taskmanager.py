@@ -195,6 +195,8 @@ class Task(Base):
 
 
 class TaskLog(Base):
+    # partitioned by run on PostgreSQL, the table is created by
+    # ``partitions.setup`` with the primary key (id, run) there
     __tablename__ = 'task_log'
     id = _sa.Column(
         _sa.BigInteger,
@@ -231,3 +233,254 @@ class TaskLog(Base):
         self.run = run
         self.state = state
         self.worker_id = worker_id
+
+
+archive_dependencies = _sa.Table(
+    'task_dependencies_archive', Base.metadata,
+    _sa.Column('task_id', _sa.BigInteger, primary_key=True),
+    _sa.Column('depend_id', _sa.BigInteger, primary_key=True),
+)
+
+
+class TaskArchive(Base):
+    """ Finished task moved out of ``tasks`` by the archiver
+
+    Same columns and relationships as ``Task`` (read only), so it dumps
+    with the ``Tasks`` schema. There are no foreign keys, scripts and
+    queues of archived tasks may be gone.
+    """
+    __tablename__ = 'tasks_archive'
+    id = _sa.Column(_sa.BigInteger, primary_key=True)
+    script_id = _sa.Column(_sa.Integer, index=True)
+    worker_id = _sa.Column(_sa.Integer, index=True)
+    scheduled = _sa.Column(_sa.DateTime, index=True)
+    title = _sa.Column(_sa.Text)
+    run = _sa.Column(_sa.DateTime)
+    state = _sa.Column(_sa.Text)
+    locks = _sa.Column(_sa.Text)
+    options = _sa.Column(_sa.JSON())
+    scheduled_by = _sa.Column(_sa.Text)
+    parent_id = _sa.Column(_sa.BigInteger, index=True)
+    archived = _sa.Column(_sa.DateTime, server_default=_sa.func.now())
+
+    script = _orm.relationship(
+        'Script',
+        primaryjoin='foreign(TaskArchive.script_id) == Script.id',
+        viewonly=True,
+        lazy="joined",
+    )
+    worker = _orm.relationship(
+        'WorkerQueue',
+        primaryjoin='foreign(TaskArchive.worker_id) == WorkerQueue.id',
+        viewonly=True,
+        lazy="joined",
+    )
+    parent = _orm.relationship(
+        'TaskArchive',
+        primaryjoin='foreign(TaskArchive.parent_id) == remote(TaskArchive.id)',
+        viewonly=True,
+    )
+    children = _orm.relationship(
+        'TaskArchive',
+        primaryjoin='remote(foreign(TaskArchive.parent_id)) == TaskArchive.id',
+        viewonly=True,
+    )
+    depends = _orm.relationship(
+        'TaskArchive',
+        secondary=archive_dependencies,
+        primaryjoin=id == _orm.foreign(archive_dependencies.c.task_id),
+        secondaryjoin=id == _orm.foreign(archive_dependencies.c.depend_id),
+        viewonly=True,
+    )
+    logs = _orm.relationship(
+        'TaskLogArchive',
+        primaryjoin='foreign(TaskLogArchive.task_id) == TaskArchive.id',
+        viewonly=True,
+    )
+
+
+class TaskLogArchive(Base):
+    """ ``task_log`` rows of archived tasks """
+    __tablename__ = 'task_log_archive'
+    id = _sa.Column(_sa.BigInteger, primary_key=True)
+    task_id = _sa.Column(_sa.BigInteger, index=True)
+    run = _sa.Column(_sa.DateTime)
+    state = _sa.Column(_sa.Text)
+    worker_id = _sa.Column(_sa.Integer)
+
+    worker = _orm.relationship(
+        'Worker',
+        primaryjoin='foreign(TaskLogArchive.worker_id) == Worker.id',
+        viewonly=True,
+        lazy="joined",
+    )
+
+
+class TaskCounter(Base):
+    """ Change of the number of tasks per state, queue and team
+
+    Written by triggers on ``tasks`` (PostgreSQL only), one row per
+    statement and (state, queue, team), never updated, so writers don't
+    lock each other. The number of tasks is the sum of the rows, reading
+    it doesn't scan the tasks. ``team_id`` 0 stands for scripts without
+    a team. ``compact_task_counters`` folds the rows, drift (e.g. a
+    script moved to another team) is fixed by
+    ``reconcile_task_counters``.
+    """
+    __tablename__ = 'task_counter_deltas'
+    id = _sa.Column(_sa.BigInteger, primary_key=True)
+    state = _sa.Column(_sa.Text, nullable=False)
+    worker_id = _sa.Column(_sa.Integer, nullable=False)
+    team_id = _sa.Column(_sa.Integer, nullable=False)
+    count = _sa.Column(_sa.BigInteger, nullable=False)
+
+
+# statement triggers with transition tables, a batch insert writes one
+# row per (state, queue, team) instead of touching a counter per task
+TASK_COUNTER_FUNCTION = """
+DROP TABLE IF EXISTS task_counters;
+CREATE OR REPLACE FUNCTION task_counters_update() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO task_counter_deltas (state, worker_id, team_id, count)
+        SELECT
+            COALESCE(new_rows.state, ''),
+            COALESCE(new_rows.worker_id, 0),
+            COALESCE(scripts.team_id, 0),
+            count(1)
+        FROM new_rows
+        LEFT JOIN scripts ON scripts.id = new_rows.script_id
+        GROUP BY 1, 2, 3;
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO task_counter_deltas (state, worker_id, team_id, count)
+        SELECT
+            COALESCE(old_rows.state, ''),
+            COALESCE(old_rows.worker_id, 0),
+            COALESCE(scripts.team_id, 0),
+            -count(1)
+        FROM old_rows
+        LEFT JOIN scripts ON scripts.id = old_rows.script_id
+        GROUP BY 1, 2, 3;
+    ELSE
+        INSERT INTO task_counter_deltas (state, worker_id, team_id, count)
+        SELECT state, worker_id, team_id, sum(count)
+        FROM (
+            SELECT
+                COALESCE(new_rows.state, '') AS state,
+                COALESCE(new_rows.worker_id, 0) AS worker_id,
+                COALESCE(scripts.team_id, 0) AS team_id,
+                1 AS count
+            FROM new_rows
+            LEFT JOIN scripts ON scripts.id = new_rows.script_id
+            UNION ALL
+            SELECT
+                COALESCE(old_rows.state, ''),
+                COALESCE(old_rows.worker_id, 0),
+                COALESCE(scripts.team_id, 0),
+                -1
+            FROM old_rows
+            LEFT JOIN scripts ON scripts.id = old_rows.script_id
+        ) changes
+        GROUP BY 1, 2, 3
+        HAVING sum(count) <> 0;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+# transition tables allow one event per trigger and no column list
+TASK_COUNTER_TRIGGER = """
+DROP TRIGGER IF EXISTS task_counters_update ON tasks;
+DROP TRIGGER IF EXISTS task_counters_insert ON tasks;
+DROP TRIGGER IF EXISTS task_counters_update_rows ON tasks;
+DROP TRIGGER IF EXISTS task_counters_delete ON tasks;
+CREATE TRIGGER task_counters_insert
+    AFTER INSERT ON tasks REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE task_counters_update();
+CREATE TRIGGER task_counters_update_rows
+    AFTER UPDATE ON tasks
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE task_counters_update();
+CREATE TRIGGER task_counters_delete
+    AFTER DELETE ON tasks REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE task_counters_update()
+"""
+
+# runs on every create_all, the statements are idempotent so existing
+# databases get the trigger too
+_sa.event.listen(
+    Base.metadata,
+    'after_create',
+    _sa.DDL(TASK_COUNTER_FUNCTION).execute_if(dialect='postgresql'),
+)
+_sa.event.listen(
+    Base.metadata,
+    'after_create',
+    _sa.DDL(TASK_COUNTER_TRIGGER).execute_if(dialect='postgresql'),
+)
+
+
+class TableVersion(Base):
+    """ Change of a table, the version of a table is the sum of its rows
+
+    Every transaction writing a table of ``TABLE_VERSION_TABLES`` inserts
+    one row (never updates one), so writers don't lock each other and a
+    change is visible exactly when its data is. ``compact_table_versions``
+    folds the rows into one per table. Used to derive ETags without
+    reading the data itself.
+    """
+    __tablename__ = 'table_version_deltas'
+    id = _sa.Column(_sa.BigInteger, primary_key=True)
+    name = _sa.Column(_sa.Text, nullable=False, index=True)
+    count = _sa.Column(_sa.BigInteger, nullable=False, server_default='1')
+
+
+TABLE_VERSION_TABLES = (
+    'teams',
+    'scripts',
+    'workers',
+    'worker_queues',
+    'tasks',
+    'task_dependencies',
+    'task_log',
+    'tasks_archive',
+)
+
+# the versioned table is passed as argument, TG_TABLE_NAME would be the
+# partition for writes routed to partitions of task_log
+TABLE_VERSION_FUNCTION = """
+DROP TABLE IF EXISTS table_versions;
+CREATE OR REPLACE FUNCTION table_versions_bump() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('taskmanager.version_' || TG_ARGV[0], true)
+            IS DISTINCT FROM 'bumped' THEN
+        INSERT INTO table_version_deltas (name) VALUES (TG_ARGV[0]);
+        PERFORM set_config('taskmanager.version_' || TG_ARGV[0], 'bumped', true);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+TABLE_VERSION_TRIGGER = """
+DROP SEQUENCE IF EXISTS table_version_{table};
+DROP TRIGGER IF EXISTS table_versions_bump ON {table};
+CREATE TRIGGER table_versions_bump
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+    FOR EACH STATEMENT EXECUTE PROCEDURE table_versions_bump('{table}')
+"""
+
+_sa.event.listen(
+    Base.metadata,
+    'after_create',
+    _sa.DDL(TABLE_VERSION_FUNCTION).execute_if(dialect='postgresql'),
+)
+for _table in TABLE_VERSION_TABLES:
+    _sa.event.listen(
+        Base.metadata,
+        'after_create',
+        _sa.DDL(
+            TABLE_VERSION_TRIGGER.format(table=_table)
+        ).execute_if(dialect='postgresql'),
+    )
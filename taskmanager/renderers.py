@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import datetime as _dt
+import decimal as _decimal
+import gzip as _gzip
+import json as _json
+
+from pyramid.settings import asbool
+
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
+try:
+    import brotli as _brotli
+except ImportError:
+    _brotli = None
+
+# responses smaller than this are sent uncompressed
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_TYPES = (
+    "application/json",
+    "application/javascript",
+    "text/",
+)
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def _default(obj):
+    """ types marshmallow or the views leave in the data """
+    if hasattr(obj, "__json__"):
+        return obj.__json__(None)
+    if isinstance(obj, (_dt.datetime, _dt.date, _dt.time)):
+        return obj.isoformat()
+    if isinstance(obj, _decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def dumps_orjson(value):
+    return _orjson.dumps(
+        value,
+        default=_default,
+        option=_orjson.OPT_NON_STR_KEYS,
+    )
+
+
+def dumps_stdlib(value):
+    return _json.dumps(value, default=_default).encode("utf-8")
+
+
+class JSONRenderer(object):
+    """ JSON renderer with a pluggable encoder
+
+    ``dumps`` takes the value and returns the encoded bytes, by default
+    orjson is used if it is installed.
+    """
+
+    def __init__(self, dumps=None):
+        if dumps is None:
+            dumps = dumps_orjson if _orjson is not None else dumps_stdlib
+        self.dumps = dumps
+
+    def __call__(self, info):
+        def _render(value, system):
+            request = system.get("request")
+            if request is not None:
+                response = request.response
+                if response.content_type == response.default_content_type:
+                    response.content_type = "application/json"
+            return self.dumps(value)
+        return _render
+
+
+def _accepted_encodings(header):
+    """ content codings of an Accept-Encoding header with q > 0 """
+    accepted = set()
+    for part in (header or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(coding)
+    return accepted
+
+
+def choose_encoding(header):
+    """ best supported content coding for an Accept-Encoding header """
+    accepted = _accepted_encodings(header)
+    if _brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+def _compressible(response, min_size):
+    if response.content_encoding or response.status_code != 200:
+        return False
+    # streamed responses (events, output follow) have no length
+    if response.content_length is None or response.content_length < min_size:
+        return False
+    return (response.content_type or "").startswith(COMPRESS_TYPES)
+
+
+def compression_tween_factory(handler, registry):
+    """ compress responses above ``taskmanager.compress_min_size`` bytes
+
+    brotli is preferred over gzip if the client accepts it and the module
+    is installed.
+    """
+    settings = registry.settings
+    if not asbool(settings.get("taskmanager.compress", True)):
+        return handler
+    min_size = int(settings.get(
+        "taskmanager.compress_min_size",
+        COMPRESS_MIN_SIZE,
+    ))
+
+    def compression_tween(request):
+        response = handler(request)
+        if not _compressible(response, min_size):
+            return response
+        vary = tuple(response.vary or ())
+        if "Accept-Encoding" not in vary:
+            response.vary = vary + ("Accept-Encoding",)
+        encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+        if encoding == "br":
+            response.body = _brotli.compress(
+                response.body,
+                quality=BROTLI_QUALITY,
+            )
+        elif encoding == "gzip":
+            response.body = _gzip.compress(
+                response.body,
+                compresslevel=GZIP_LEVEL,
+            )
+        else:
+            return response
+        response.content_encoding = encoding
+        return response
+
+    return compression_tween
+
+
+def includeme(config):
+    """
+    Replace the ``json`` renderer used by all views and compress
+    responses.
+
+    Activate this setup using ``config.include('taskmanager.renderers')``.
+
+    """
+    settings = config.get_settings()
+    dumps = None
+    if settings.get("taskmanager.json_encoder") == "json":
+        dumps = dumps_stdlib
+    config.add_renderer("json", JSONRenderer(dumps))
+    config.add_tween("taskmanager.renderers.compression_tween_factory")
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import logging as _logging
+import sys as _sys
+import time as _time
+import datetime as _dt
+
+import click as _click
+
+import pyramid.paster as _paster
+
+import taskmanager.models as _models
+import taskmanager.models.archive as _archive
+
+_log = _logging.getLogger(__name__)
+
+
+def _archive_all(engine, before, batch_size):
+    """ archive batch by batch until nothing is left, returns the count
+
+    A batch may archive less than ``batch_size`` tasks while more are
+    left (tasks still referenced are skipped), only an empty one ends.
+    A failed batch (e.g. a deadlock) ends the run, the next one retries.
+    """
+    total = 0
+    while True:
+        # one short transaction per batch, scheduler and API keep working
+        try:
+            with engine.begin() as connection:
+                archived = _archive.archive_tasks(connection, before, batch_size)
+        except Exception as e:
+            _log.error("Archiving failed %r", e)
+            return total
+        total += archived
+        if not archived:
+            return total
+
+
+@_click.command()
+@_click.argument('config', required=True)
+@_click.option(
+    '--age',
+    default=7,
+    help='days after which finished tasks are archived'
+)
+@_click.option(
+    '--interval',
+    default=3600,
+    help='seconds between archive runs'
+)
+@_click.option(
+    '--batch-size',
+    default=1000,
+    help='tasks archived per transaction'
+)
+@_click.option('--once', is_flag=True, help='archive once and exit')
+def archiver(config, age, interval, batch_size, once):
+    """ Move finished tasks older than --age days to the archive tables """
+    _paster.setup_logging(config)
+    settings = _paster.get_appsettings(config)
+    engine = _models.get_engine(settings)
+    _log.info("Archiver up and running...")
+    while True:
+        before = _dt.datetime.utcnow() - _dt.timedelta(days=age)
+        archived = _archive_all(engine, before, batch_size)
+        _log.info("Archived %d tasks scheduled before %s", archived, before)
+        if once:
+            return
+        _time.sleep(interval)
+
+
+def main(argv=tuple(_sys.argv)):
+    archiver()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import logging as _logging
+import sys as _sys
+
+import click as _click
+
+import pyramid.paster as _paster
+from sqlalchemy import text
+
+import taskmanager.models as _models
+import taskmanager.models.migrations as _migrations
+
+_log = _logging.getLogger(__name__)
+
+_UNUSED = """
+SELECT
+    stat.relname, stat.indexrelname, stat.idx_scan,
+    pg_size_pretty(pg_relation_size(stat.indexrelid))
+FROM
+    pg_stat_user_indexes stat
+JOIN
+    pg_index ON pg_index.indexrelid = stat.indexrelid
+WHERE
+    stat.idx_scan <= :max_scans
+    AND NOT pg_index.indisunique
+ORDER BY
+    pg_relation_size(stat.indexrelid) DESC
+"""
+
+_INVALID = """
+SELECT
+    pg_index.indrelid::regclass::text, pg_index.indexrelid::regclass::text
+FROM
+    pg_index
+WHERE
+    NOT pg_index.indisvalid
+"""
+
+_SEQ_SCANS = """
+SELECT
+    relname, seq_scan, seq_tup_read, COALESCE(idx_scan, 0), n_live_tup
+FROM
+    pg_stat_user_tables
+WHERE
+    seq_scan > COALESCE(idx_scan, 0)
+    AND n_live_tup >= :min_rows
+ORDER BY
+    seq_tup_read DESC
+"""
+
+
+@_click.command()
+@_click.argument('config', required=True)
+@_click.option(
+    '--max-scans',
+    default=0,
+    help='report indexes used at most this often as unused'
+)
+@_click.option(
+    '--min-rows',
+    default=10000,
+    help='report sequential scans of tables with at least this many rows'
+)
+def index_report(config, max_scans, min_rows):
+    """ Report unused, missing and invalid indexes and tables read by
+    sequential scans
+
+    The usage counters are collected since the last statistics reset
+    (pg_stat_reset), run it on a database that has served real traffic.
+    """
+    _paster.setup_logging(config)
+    settings = _paster.get_appsettings(config)
+    engine = _models.get_engine(settings)
+    if engine.dialect.name != 'postgresql':
+        _click.echo(f"Index statistics need PostgreSQL, not {engine.dialect.name}")
+        return
+
+    with engine.connect() as connection:
+        existing = {
+            name
+            for name, in connection.execute(text(
+                "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()"
+            ))
+        }
+        done = _migrations.applied(connection)
+        pending = [
+            name
+            for name, _statement, _concurrent in _migrations.MIGRATIONS
+            if name not in done
+        ]
+        missing = [
+            name
+            for name in _migrations.index_names()
+            if name not in existing
+        ]
+        unused = connection.execute(text(_UNUSED), {'max_scans': max_scans}).fetchall()
+        invalid = connection.execute(text(_INVALID)).fetchall()
+        seq_scans = connection.execute(text(_SEQ_SCANS), {'min_rows': min_rows}).fetchall()
+
+    _click.echo("Pending migrations:")
+    for name in pending:
+        _click.echo(f"  {name}")
+    _click.echo("Missing indexes (run initialize_taskmanager_db):")
+    for name in missing:
+        _click.echo(f"  {name}")
+    _click.echo("Invalid indexes (drop and run initialize_taskmanager_db):")
+    for table, name in invalid:
+        _click.echo(f"  {table}: {name}")
+    _click.echo(f"Unused indexes (at most {max_scans} scans):")
+    for table, name, scans, size in unused:
+        _click.echo(f"  {table}: {name} ({scans} scans, {size})")
+    _click.echo("Tables read mostly by sequential scans:")
+    for table, seq_scan, seq_read, idx_scan, rows in seq_scans:
+        _click.echo(
+            f"  {table}: {seq_scan} sequential scans ({seq_read} rows read), "
+            f"{idx_scan} index scans, {rows} rows"
+        )
+
+
+def main(argv=tuple(_sys.argv)):
+    index_report()
@@ -10,10 +10,13 @@ from pyramid.paster import (
 from pyramid.scripts.common import parse_vars
 
 from ..models.meta import Base
+from ..models import migrations
+from ..models import partitions
 from ..models import (
     get_engine,
     get_session_factory,
     get_tm_session,
+    reconcile_task_counters,
     )
 from ..models import (
     Team,
@@ -40,10 +43,17 @@ def main(argv=sys.argv):
     settings = get_appsettings(config_uri, options=options)
 
     engine = get_engine(settings)
+    # task_log has to be created (or converted) as partitioned table first
+    partitions.setup(engine)
     Base.metadata.create_all(engine)
+    # indexes for the scheduler and list queries
+    migrations.migrate(engine)
 
     session_factory = get_session_factory(engine)
 
+    # fill the counters for tasks created before the trigger existed
+    reconcile_task_counters(engine)
+
     # with transaction.manager:
     #     dbsession = get_tm_session(session_factory, transaction.manager)
 
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import logging as _logging
+import sys as _sys
+import datetime as _dt
+import time as _time
+
+import click as _click
+
+import pyramid.paster as _paster
+
+import taskmanager.models as _models
+import taskmanager.models.partitions as _partitions
+import taskmanager.models.archive as _archive
+import taskmanager.spool as _spool
+import taskmanager.views as _views
+
+_log = _logging.getLogger(__name__)
+
+
+@_click.command()
+@_click.argument('config', required=True)
+@_click.option(
+    '--log-months',
+    default=12,
+    help='months of task_log partitions to keep'
+)
+@_click.option(
+    '--task-days',
+    default=90,
+    help='days to keep finished (and archived) tasks, 0 keeps them forever'
+)
+@_click.option(
+    '--months-ahead',
+    default=2,
+    help='months of task_log partitions to create in advance'
+)
+@_click.option(
+    '--detach-only',
+    is_flag=True,
+    help='detach old partitions instead of dropping them'
+)
+@_click.option(
+    '--batch-size',
+    default=1000,
+    help='finished tasks deleted per transaction'
+)
+@_click.option(
+    '--spool-days',
+    default=30,
+    help='days to keep spooled script output, 0 keeps it forever'
+)
+def retention(
+        config,
+        log_months,
+        task_days,
+        months_ahead,
+        detach_only,
+        batch_size,
+        spool_days,
+):
+    """ Create upcoming and remove old task_log partitions, delete old
+    finished tasks and spooled output
+
+    The spool directory has to be mounted where this runs.
+
+    Run it at least once a month (e.g. daily from cron).
+    """
+    _paster.setup_logging(config)
+    settings = _paster.get_appsettings(config)
+    engine = _models.get_engine(settings)
+    if engine.dialect.name != 'postgresql':
+        _log.error("Partitioning needs PostgreSQL, not %s", engine.dialect.name)
+        return
+
+    now = _dt.datetime.utcnow()
+    if spool_days:
+        removed = _spool.remove_outputs(
+            _views.SPOOL_DIR,
+            _time.time() - spool_days * 86400,
+        )
+        _log.info("Removed spooled output of %d tasks", removed)
+
+    with engine.begin() as connection:
+        _partitions.ensure_partitions(connection, months_ahead)
+        removed = _partitions.drop_partitions(
+            connection,
+            _partitions.add_months(_partitions.month_start(now), -log_months),
+            detach_only=detach_only,
+        )
+    _log.info("Removed %d task_log partitions", len(removed))
+
+    if not task_days:
+        return
+    before = now - _dt.timedelta(days=task_days)
+    deleted = batch_size
+    total = 0
+    # short transactions, the scheduler and API keep working meanwhile
+    while deleted == batch_size:
+        with engine.begin() as connection:
+            deleted = _partitions.delete_finished_tasks(
+                connection,
+                before,
+                batch_size,
+            )
+        total += deleted
+    _log.info("Deleted %d finished tasks scheduled before %s", total, before)
+
+    deleted = batch_size
+    total = 0
+    while deleted == batch_size:
+        with engine.begin() as connection:
+            deleted = _archive.delete_archived_tasks(
+                connection,
+                before,
+                batch_size,
+            )
+        total += deleted
+    _log.info("Deleted %d archived tasks scheduled before %s", total, before)
+
+
+def main(argv=tuple(_sys.argv)):
+    retention()
@@ -6,8 +6,11 @@ import sys as _sys
 import transaction as _tm
 import datetime as _dt
 import functools as _ft
+import collections as _collections
+import time as _time
 
 import click as _click
+import zope.sqlalchemy as _zope
 
 import pyramid.paster as _paster
 
@@ -25,116 +28,453 @@ _EVENT_TO_STATE = {
     "task-retried": "RETRIED",
 }
 
-_HOSTNAME_TO_NAME = {}
+# states which may make other tasks ready to run (or to restart)
+_WAKEUP_STATES = (_models.NOTIFY_SUCCEED, _models.NOTIFY_FAILED)
 
 
-def _worker_events(state, capp, session_factory, event):
+def _remember(cache, key, entry, max_size):
+    """ store entry in an OrderedDict, dropping the least recently used """
+    cache[key] = entry
+    cache.move_to_end(key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+    return entry
+
+
+class QueueCache(object):
+    """ Cache hostname -> queue name of the celery workers
+
+    Asking a worker for its queues is a remote control broadcast which
+    blocks the event receiver, so it is only done on ``worker-online``,
+    for unknown hosts or once an entry is older than ``ttl`` seconds.
+    At most ``max_size`` workers are kept.
+    """
+
+    def __init__(self, capp, ttl=300, max_size=1024):
+        self._capp = capp
+        self._ttl = ttl
+        self._max_size = max_size
+        # hostname -> (queue name, expires)
+        self._entries = _collections.OrderedDict()
+
+    def _inspect(self, hostname):
+        inspect = self._capp.control.inspect(destination=[hostname])
+        active_queue = inspect.active_queues()
+        if not active_queue or not active_queue.get(hostname):
+            return None
+        return active_queue[hostname][0]["name"]
+
+    def fresh(self, hostname):
+        """ True if the queue of the worker is known and not expired """
+        return self._entries.get(hostname, (None, 0))[1] > _time.monotonic()
+
+    def cached(self, hostname):
+        """ queue name of the worker without asking it, even if expired """
+        return self._entries.get(hostname, (None, 0))[0]
+
+    def forget(self, hostname):
+        self._entries.pop(hostname, None)
+
+    def get(self, hostname, refresh=False):
+        """ queue name of the worker, None if unknown
+
+        An expired entry is still returned if the worker doesn't answer.
+        """
+        name, expires = self._entries.get(hostname, (None, 0))
+        if not refresh and name is not None and expires > _time.monotonic():
+            return name
+
+        active_name = self._inspect(hostname)
+        if active_name is None:
+            return name
+        _remember(
+            self._entries,
+            hostname,
+            (active_name, _time.monotonic() + self._ttl),
+            self._max_size,
+        )
+        return active_name
+
+
+class WorkerCache(object):
+    """ Resident ids and states of workers and queues
+
+    Maps hostname -> ``[worker id, state]`` and queue name ->
+    ``[queue id, state]``. Filled at startup and on first sight, so
+    events only touch the database for the writes they need. Workers
+    are dropped on ``worker-offline`` and re-read on ``worker-online``,
+    both maps keep at most ``max_size`` entries.
+    """
+
+    def __init__(self, max_size=1024):
+        self._max_size = max_size
+        self._workers = _collections.OrderedDict()
+        self._queues = _collections.OrderedDict()
+
+    def load(self, session_factory):
+        with _tm.manager:
+            dbsession = _models.get_tm_session(session_factory, _tm.manager)
+            for cache, model in (
+                    (self._workers, _models.Worker),
+                    (self._queues, _models.WorkerQueue),
+            ):
+                rows = dbsession.query(
+                    model.id,
+                    model.name,
+                    model.state,
+                ).order_by(
+                    model.id
+                ).limit(
+                    self._max_size
+                )
+                for entry_id, name, state in rows:
+                    _remember(cache, name, [entry_id, state], self._max_size)
+
+    def _lookup(self, cache, model, dbsession, name):
+        entry = cache.get(name)
+        if entry is not None:
+            cache.move_to_end(name)
+            return entry
+        row = dbsession.query(
+            model.id,
+            model.state,
+        ).filter(
+            model.name == name
+        ).first()
+        if row is None:
+            return None
+        return _remember(cache, name, list(row), self._max_size)
+
+    def _add(self, cache, model, dbsession, name, state):
+        obj = model(name, state)
+        dbsession.add(obj)
+        dbsession.flush()
+        return _remember(cache, name, [obj.id, state], self._max_size)
+
+    def cached_worker(self, hostname):
+        return self._workers.get(hostname)
+
+    def cached_queue(self, name):
+        return self._queues.get(name)
+
+    def worker(self, dbsession, hostname):
+        return self._lookup(self._workers, _models.Worker, dbsession, hostname)
+
+    def queue(self, dbsession, name):
+        return self._lookup(self._queues, _models.WorkerQueue, dbsession, name)
+
+    def add_worker(self, dbsession, hostname, state):
+        return self._add(
+            self._workers,
+            _models.Worker,
+            dbsession,
+            hostname,
+            state,
+        )
+
+    def add_queue(self, dbsession, name, state="active"):
+        return self._add(
+            self._queues,
+            _models.WorkerQueue,
+            dbsession,
+            name,
+            state,
+        )
+
+    def forget_worker(self, hostname):
+        self._workers.pop(hostname, None)
+
+    def forget_queue(self, name):
+        self._queues.pop(name, None)
+
+    def worker_ids(self, dbsession, hostnames):
+        """ hostname -> worker id, unknown hosts are looked up at once """
+        missing = [name for name in hostnames if name not in self._workers]
+        if missing:
+            rows = dbsession.query(
+                _models.Worker.id,
+                _models.Worker.name,
+                _models.Worker.state,
+            ).filter(
+                _models.Worker.name.in_(missing)
+            )
+            for worker_id, name, state in rows:
+                _remember(
+                    self._workers,
+                    name,
+                    [worker_id, state],
+                    self._max_size,
+                )
+        return {
+            name: self._workers[name][0]
+            for name in hostnames
+            if name in self._workers
+        }
+
+
+def _worker_events(state, queues, workers, session_factory, event):
     state.event(event)
     hostname = event["hostname"]
-    inspect = capp.control.inspect(destination=[hostname])
-    active_queue = inspect.active_queues()
-    if not active_queue:
-        if hostname not in _HOSTNAME_TO_NAME:
+    event_type = event["type"]
+    worker_state = "OFFLINE" if event_type == "worker-offline" else "ONLINE"
+    if event_type == "worker-heartbeat" and queues.fresh(hostname):
+        worker = workers.cached_worker(hostname)
+        queue = workers.cached_queue(queues.cached(hostname))
+        if (
+            worker and worker[1] == worker_state
+            and queue and queue[1] == "active"
+        ):
+            # nothing changed since the worker was marked ONLINE
             return
-        name = _HOSTNAME_TO_NAME[hostname]
+
+    if event_type == "worker-offline":
+        # an offline worker doesn't answer anymore, don't ask it
+        name = queues.cached(hostname)
     else:
-        active_queue = active_queue[hostname][0]
-        name = active_queue["name"]
-        _HOSTNAME_TO_NAME[hostname] = name
+        name = queues.get(hostname, refresh=event_type == "worker-online")
+    if name is None:
+        return
+
+    if event_type == "worker-online":
+        # states might have been changed meanwhile, e.g. through the API
+        workers.forget_worker(hostname)
+        workers.forget_queue(name)
+
+    try:
+        with _tm.manager:
+            dbsession = _models.get_tm_session(session_factory, _tm.manager)
+            _update_worker(dbsession, workers, hostname, name, worker_state)
+    except Exception:
+        # the cached states were changed, but the transaction failed
+        workers.forget_worker(hostname)
+        workers.forget_queue(name)
+        raise
+
+    if event_type == "worker-offline":
+        workers.forget_worker(hostname)
+        queues.forget(hostname)
+
 
-    with _tm.manager:
-        dbsession = _models.get_tm_session(session_factory, _tm.manager)
-        worker_queue = dbsession.query(
+def _update_worker(dbsession, workers, hostname, name, worker_state):
+    worker_queue = workers.queue(dbsession, name)
+    if worker_queue is None:
+        worker_queue = workers.add_queue(dbsession, name)
+        _log.info(
+            "New Queue created {}".format(
+                name,
+            )
+        )
+
+    if worker_queue[1] != 'active':
+        _log.info(
+            "Queue {}: {} -> active".format(
+                name,
+                worker_queue[1],
+            )
+        )
+        dbsession.query(
             _models.WorkerQueue
         ).filter(
-            _models.WorkerQueue.name == name
-        ).first()
+            _models.WorkerQueue.id == worker_queue[0]
+        ).update(
+            {_models.WorkerQueue.state: 'active'},
+            synchronize_session=False,
+        )
+        worker_queue[1] = 'active'
+        _models.notify_scheduler(
+            dbsession,
+            _models.NOTIFY_QUEUE,
+            name,
+        )
+
+    worker = workers.worker(dbsession, hostname)
+    if worker is None:
+        worker = workers.add_worker(dbsession, hostname, "OFFLINE")
 
-        worker = dbsession.query(
+    if worker[1] != worker_state:
+        dbsession.query(
             _models.Worker
         ).filter(
-            _models.Worker.name == hostname
-        ).first()
+            _models.Worker.id == worker[0]
+        ).update(
+            {_models.Worker.state: worker_state},
+            synchronize_session=False,
+        )
+        worker[1] = worker_state
+        _log.info("Worker {} -> {}".format(hostname, worker_state))
 
-        if not worker_queue:
-            worker_queue = _models.WorkerQueue(name)
-            dbsession.add(worker_queue)
-            _log.info(
-                "New Queue created {}".format(
-                    worker_queue.name,
-                )
-            )
 
-        if worker_queue.state != 'active':
-            _log.info(
-                "Queue {}: {} -> active".format(
-                    worker_queue.name,
-                    worker_queue.state,
-                )
-            )
-            worker_queue.state = 'active'
+class TaskEventBuffer(object):
+    """ Write-behind buffer for celery task events
 
-        if not worker:
-            worker = _models.Worker(hostname, "OFFLINE")
-            dbsession.add(worker)
+    Events are collected for up to ``max_wait`` seconds or
+    ``max_events`` events and then written in one transaction: one
+    UPDATE per task and one bulk INSERT of all ``TaskLog`` rows. Events
+    are applied in the order they were received, so the per-task order
+    is preserved.
 
-        if event["type"] in ("worker-heartbeat", "worker-online"):
-            if worker.state != "ONLINE":
-                worker.state = "ONLINE"
-                _log.info("Worker {} -> ONLINE".format(worker.name))
-        elif event["type"] in ("worker-offline",):
-            if worker.state != "OFFLINE":
-                worker.state = "OFFLINE"
-                _log.info("Worker {} -> OFFLINE".format(worker.name))
+    Events stay buffered until their transaction committed. A failed
+    write (deadlock, lost connection) is logged and retried with backoff,
+    at most ``max_pending`` events are kept meanwhile.
 
+    Without new events the buffer is only checked when the receiver
+    wakes up, about once a second, so an event of an idle system waits
+    up to a second instead of ``max_wait``.
+    """
+    # longest pause between retries of a failed write
+    MAX_RETRY_WAIT = 30
 
-def _task_events(state, session_factory, event):
-    state.event(event)
-    task_id = event["uuid"]
-    with _tm.manager:
+    def __init__(
+            self,
+            session_factory,
+            workers,
+            max_events=200,
+            max_wait=0.2,
+            max_pending=None,
+    ):
+        self._session_factory = session_factory
+        self._workers = workers
+        self._max_events = max_events
+        self._max_wait = max_wait
+        self._max_pending = max_pending or max_events * 100
+        self._events = []
+        self._first = None
+        self._failures = 0
+        self._retry_at = None
+
+    def add(self, event):
+        task_id = event["uuid"]
         try:
-            int(task_id)
+            task_id = int(task_id)
         except ValueError:
             _log.info("ID is not a integer {}".format(task_id))
             return
-        dbsession = _models.get_tm_session(session_factory, _tm.manager)
-        task = dbsession.query(_models.Task).get(task_id)
-        event_type = event["type"]
-        task_state = _EVENT_TO_STATE.get(event_type)
-        if task_state == "STARTED":
-            task.run = _dt.datetime.utcnow()
+        if not self._events:
+            self._first = _time.monotonic()
+        self._events.append((task_id, event, _dt.datetime.utcnow()))
+        self.flush_if_due()
 
-        _log.info(
-            "Task {} [{:7} -> {}] @ {}".format(
-                task.id,
-                task.state,
-                task_state,
-                event['hostname']
+    def flush_if_due(self):
+        if not self._events:
+            return
+        if self._retry_at is not None and _time.monotonic() < self._retry_at:
+            return
+        if (
+            len(self._events) >= self._max_events
+            or _time.monotonic() - self._first >= self._max_wait
+        ):
+            self.flush()
+
+    def flush(self):
+        """ write all buffered events
+
+        Returns:
+            bool: False if the write failed, the events are kept
+        """
+        if not self._events:
+            return True
+        try:
+            with _tm.manager:
+                dbsession = _models.get_tm_session(
+                    self._session_factory,
+                    _tm.manager,
+                )
+                self._apply(dbsession, self._events)
+        except Exception as e:
+            self._failures += 1
+            wait = min(self._max_wait * 2 ** self._failures, self.MAX_RETRY_WAIT)
+            self._retry_at = _time.monotonic() + wait
+            _log.error(
+                "Writing {} task events failed, retry in {:.1f}s: {!r}".format(
+                    len(self._events),
+                    wait,
+                    e,
+                )
+            )
+            dropped = len(self._events) - self._max_pending
+            if dropped > 0:
+                _log.error("Dropping {} oldest task events".format(dropped))
+                del self._events[:dropped]
+            return False
+        self._events = []
+        self._failures = 0
+        self._retry_at = None
+        return True
+
+    def _apply(self, dbsession, events):
+        task_ids = {task_id for task_id, _event, _received in events}
+        hostnames = {event["hostname"] for _id, event, _received in events}
+        task_states = dict(
+            dbsession.query(
+                _models.Task.id,
+                _models.Task.state,
+            ).filter(
+                _models.Task.id.in_(task_ids)
             )
         )
+        worker_ids = self._workers.worker_ids(dbsession, hostnames)
+
+        updates = {}
+        logs = []
+        for task_id, event, received in events:
+            if task_id not in task_states:
+                _log.info("Task {} not found".format(task_id))
+                continue
+            task_state = _EVENT_TO_STATE.get(event["type"])
+            _log.info(
+                "Task {} [{:7} -> {}] @ {}".format(
+                    task_id,
+                    task_states[task_id],
+                    task_state,
+                    event['hostname']
+                )
+            )
+            update = updates.setdefault(task_id, {"id": task_id})
+            if task_state == "STARTED":
+                update["run"] = received
+            if task_state:
+                task_states[task_id] = update["state"] = task_state
+                if task_state in _WAKEUP_STATES:
+                    _models.notify_scheduler(dbsession, task_state, task_id)
 
-        if task_state:
-            task.state = task_state
+            logs.append({
+                "task_id": task_id,
+                "run": received,
+                "state": task_states[task_id],
+                "worker_id": worker_ids.get(event["hostname"]),
+            })
 
-        worker = dbsession.query(
-            _models.Worker
-        ).filter(
-            _models.Worker.name == event["hostname"]
-        ).one()
-        log_entry = _models.TaskLog(
-            task.id,
-            _dt.datetime.utcnow(),
-            task.state,
-            worker.id,
-        )
-        log_entry.task = task
-        log_entry.worker = worker
-        dbsession.add(log_entry)
+        updates = [update for update in updates.values() if len(update) > 1]
+        dbsession.bulk_update_mappings(_models.Task, updates)
+        dbsession.bulk_insert_mappings(_models.TaskLog, logs)
+        # bulk operations don't join the zope transaction on their own
+        _zope.mark_changed(dbsession)
+
+
+def _task_events(state, buffer, event):
+    state.event(event)
+    buffer.add(event)
 
 
 @_click.command()
 @_click.argument('config', required=True)
-def state_updater(config):
+@_click.option(
+    '--queue-ttl',
+    default=300,
+    help='seconds until the queue of a worker is asked for again'
+)
+@_click.option(
+    '--batch-size',
+    default=200,
+    help='max number of task events written in one transaction'
+)
+@_click.option(
+    '--batch-wait',
+    default=200,
+    help='max milliseconds a task event is buffered before it is written, '
+         'when idle the buffer is checked about once a second'
+)
+def state_updater(config, queue_ttl, batch_size, batch_wait):
     _paster.setup_logging(config)
     settings = _paster.get_appsettings(config)
 
@@ -143,18 +483,28 @@ def state_updater(config):
 
     capp = _views.celery_app
     state = capp.events.State()
+    queues = QueueCache(capp, ttl=queue_ttl)
+    workers = WorkerCache()
+    workers.load(session_factory)
+    buffer = TaskEventBuffer(
+        session_factory,
+        workers,
+        max_events=batch_size,
+        max_wait=batch_wait / 1000.0,
+    )
 
     with _views.celery_app.connection() as connection:
         worker_events = _ft.partial(
             _worker_events,
             state,
-            capp,
+            queues,
+            workers,
             session_factory,
         )
         task_events = _ft.partial(
             _task_events,
             state,
-            session_factory,
+            buffer,
         )
         recv = _views.celery_app.events.Receiver(connection, handlers={
             "worker-online": worker_events,
@@ -166,7 +516,12 @@ def state_updater(config):
             "task-rejected": task_events,
             "task-retried": task_events,
         })
-        recv.capture(limit=None, timeout=None, wakeup=True)
+        # called after every event and at least once a second when idle
+        recv.on_iteration = buffer.flush_if_due
+        try:
+            recv.capture(limit=None, timeout=None, wakeup=True)
+        finally:
+            buffer.flush()
 
 
 def main(argv=tuple(_sys.argv)):
@@ -6,166 +6,630 @@ import sys as _sys
 import transaction as _tm
 import time as _time
 import datetime as _dt
+import select as _select
+import collections as _collections
 
 import click as _click
 
 import pyramid.paster as _paster
 
+import sqlalchemy as _sa
+import sqlalchemy.orm as _orm
+
 import taskmanager.models as _models
 import taskmanager.views as _views
 
 _log = _logging.getLogger(__name__)
 
+# everything needed to decide about and submit a task, see _load_tasks
+_SchedulerTask = _collections.namedtuple(
+    '_SchedulerTask',
+    [
+        'id',
+        'title',
+        'options',
+        'parent_id',
+        'parent_state',
+        'script_name',
+        'script_cmd',
+        'script_type',
+        'script_status',
+        'queue_name',
+        'queue_state',
+        'depends',
+    ],
+)
+
+
+def _load_tasks(session, task_ids):
+    """ Read the tasks for the scheduler with two column only queries
+
+    The ``Task`` mapper eagerly joins logs, depends, parent, ... which
+    is far more than the scheduler needs and grows with the retry
+    history, so only the needed columns are selected here.
+
+    Returns:
+        list: _SchedulerTask tuples, ``depends`` maps id to state, script
+            and queue columns are None for tasks without script or queue
+    """
+    parent = _orm.aliased(_models.Task)
+    depend = _orm.aliased(_models.Task)
+    association = _models.association_table
+
+    depends = _collections.defaultdict(dict)
+    depend_rows = session.query(
+        association.c.task_id,
+        depend.id,
+        depend.state,
+    ).select_from(
+        association
+    ).join(
+        depend,
+        depend.id == association.c.depend_id,
+    ).filter(
+        association.c.task_id.in_(task_ids)
+    )
+    for task_id, depend_id, depend_state in depend_rows:
+        depends[task_id][depend_id] = depend_state
+
+    rows = session.query(
+        _models.Task.id,
+        _models.Task.title,
+        _models.Task.options,
+        _models.Task.parent_id,
+        parent.state,
+        _models.Script.name,
+        _models.Script.cmd,
+        _models.Script.type,
+        _models.Script.status,
+        _models.WorkerQueue.name,
+        _models.WorkerQueue.state,
+    ).outerjoin(
+        _models.Script,
+        _models.Script.id == _models.Task.script_id,
+    ).outerjoin(
+        _models.WorkerQueue,
+        _models.WorkerQueue.id == _models.Task.worker_id,
+    ).outerjoin(
+        parent,
+        parent.id == _models.Task.parent_id,
+    ).filter(
+        _models.Task.id.in_(task_ids)
+    ).order_by(
+        _models.Task.id
+    )
+    return [
+        _SchedulerTask(*row, depends=depends.get(row[0], {}))
+        for row in rows
+    ]
+
 
-def _start_task(task, config):
-    params = [task.script.cmd, config, task.options]
+def _additional_info(task):
     additional_info = {}
-    if task.parent:
-        additional_info["parent_id"] = task.parent.id
+    if task.parent_id:
+        additional_info["parent_id"] = task.parent_id
+    return additional_info
+
+
+def _start_task(task, config, producer=None):
+    params = [task.script_cmd, config, task.options]
     task_run = _views.start_task.apply_async(
         args=tuple(params),
-        kwargs={"additional_info": additional_info},
+        kwargs={"additional_info": _additional_info(task)},
         task_id=str(task.id),
-        routing_key=task.worker.name,
-        queue=task.worker.name,
+        routing_key=task.queue_name,
+        queue=task.queue_name,
+        producer=producer,
     )
-    task.run = _dt.datetime.utcnow()
     return task_run
 
 
-def _start_function(task, config):
-    params = [task.script.cmd, config, task.options]
-    additional_info = {}
-    if task.parent:
-        additional_info["parent_id"] = task.parent.id
+def _start_function(task, config, producer=None):
+    params = [task.script_cmd, config, task.options]
     task_run = _views.start_function.apply_async(
         args=params,
-        kwargs={"additional_info": additional_info},
+        kwargs={"additional_info": _additional_info(task)},
         task_id=str(task.id),
-        routing_key=task.worker.name,
-        queue=task.worker.name,
+        routing_key=task.queue_name,
+        queue=task.queue_name,
+        producer=producer,
     )
-    task.run = _dt.datetime.utcnow()
     return task_run
 
 
+def _stamp_run(session, task_ids):
+    """ Set ``run`` for all started tasks with one UPDATE """
+    if not task_ids:
+        return
+    session.query(
+        _models.Task
+    ).filter(
+        _models.Task.id.in_(task_ids)
+    ).update(
+        {_models.Task.run: _dt.datetime.utcnow()},
+        synchronize_session=False,
+    )
+
+
+def _fail_unrunnable(session, tasks):
+    """ Fail the tasks without script or queue, they can never run
+
+    Returns:
+        list: the other tasks
+    """
+    unrunnable = [
+        task.id
+        for task in tasks
+        if task.script_name is None or task.queue_name is None
+    ]
+    if unrunnable:
+        _log.error("Tasks %s have no script or queue, failing them", unrunnable)
+        session.query(
+            _models.Task
+        ).filter(
+            _models.Task.id.in_(unrunnable)
+        ).update(
+            {
+                _models.Task.state: 'FAILED',
+                _models.Task.run: _dt.datetime.utcnow(),
+            },
+            synchronize_session=False,
+        )
+    return [task for task in tasks if task.id not in unrunnable]
+
+
+def _claim(query):
+    """ Lock the rows of an id query for this scheduler instance
+
+    Rows already locked by another scheduler are skipped, that instance
+    starts them. The locks are held until the transaction commits, by
+    then ``run`` is set and the tasks aren't candidates anymore.
+
+    Returns:
+        list: ids of the claimed tasks
+    """
+    return [
+        task_id
+        for task_id, in query.with_for_update(skip_locked=True)
+    ]
+
+
 def _handle_failed_tasks(session_factory, config):
     with _tm.manager:
         session = _models.get_tm_session(session_factory, _tm.manager)
-        tasks = session.query(
-            _models.Task
-        ).filter(
-            _models.Task.state == 'FAILED'
-        ).all()
+        restart_before = _dt.datetime.utcnow() - _dt.timedelta(minutes=5)
+        claimed = _claim(
+            session.query(
+                _models.Task.id
+            ).filter(
+                _models.Task.state == 'FAILED'
+            ).filter(
+                # see _fail_unrunnable
+                _models.Task.script_id.isnot(None),
+                _models.Task.worker_id.isnot(None),
+            ).filter(
+                _sa.or_(
+                    _models.Task.run.is_(None),
+                    _models.Task.run < restart_before,
+                )
+            )
+        )
+        if not claimed:
+            return
+        tasks = _load_tasks(session, claimed)
 
-        for task in tasks:
-            if task.run:
-                diff = _dt.datetime.utcnow() - task.run
-            else:
-                diff = None
-            if diff is None or diff > _dt.timedelta(minutes=5):
-                if task.script.is_script():
-                    task_run = _start_task(task, config)
-                _log.info("Restart failed task %r", task_run.id)
+        started = []
+        with _views.celery_app.producer_or_acquire() as producer:
+            for task in tasks:
+                if task.script_type == _models.Script.SCRIPT_TYPE:
+                    task_run = _start_task(task, config, producer)
+                    started.append(task.id)
+                    _log.info("Restart failed task %r", task_run.id)
+        _stamp_run(session, started)
 
 
 def _check_parent(task):
-    if task.parent is None:
+    if task.parent_id is None:
         return True
 
-    if task.parent.state == "SUCCEED":
+    if task.parent_state == "SUCCEED":
         return True
 
     return False
 
 
-def _handle_prerun_tasks(session_factory, config):
+def _pending_tasks(query, task_ids=None):
+    query = query.filter(
+        _models.Task.run.is_(None)
+    ).filter(
+        _models.Task.state == 'PRERUN'
+    )
+    if task_ids is not None:
+        query = query.filter(
+            _models.Task.id.in_(task_ids)
+        )
+    return query
+
+
+class ReadinessIndex(object):
+    """ Count of unsatisfied parents/dependencies per PRERUN task
+
+    Only tasks whose counter dropped to zero are handed to the
+    scheduler, so a scan costs work proportional to the state changes
+    instead of all pending tasks and their dependencies. The index is
+    kept in memory and can always be rebuilt from the database.
+    """
+
+    def __init__(self):
+        self._pending = {}  # task id -> ids of unsatisfied blockers
+        self._blocking = {}  # blocker id -> ids of tasks waiting for it
+        self._ready = set()
+        self._parked = set()  # ready, but queue or script not active
+
+    def _forget(self, task_id):
+        self._pending.pop(task_id, None)
+        self._ready.discard(task_id)
+        self._parked.discard(task_id)
+
+    def _register(self, task_id, blockers):
+        self._forget(task_id)
+        if not blockers:
+            self._ready.add(task_id)
+            return
+        self._pending[task_id] = set(blockers)
+        for blocker_id in blockers:
+            self._blocking.setdefault(blocker_id, set()).add(task_id)
+
+    def _load(self, session, task_ids=None):
+        parent = _orm.aliased(_models.Task)
+        depend = _orm.aliased(_models.Task)
+        association = _models.association_table
+
+        blockers = {
+            task_id: set()
+            for task_id, in _pending_tasks(
+                session.query(_models.Task.id),
+                task_ids,
+            )
+        }
+        parents = _pending_tasks(
+            session.query(
+                _models.Task.id,
+                _models.Task.parent_id,
+            ).join(
+                parent,
+                parent.id == _models.Task.parent_id,
+            ).filter(
+                parent.state != "SUCCEED"
+            ),
+            task_ids,
+        )
+        depends = _pending_tasks(
+            session.query(
+                association.c.task_id,
+                association.c.depend_id,
+            ).select_from(
+                association
+            ).join(
+                _models.Task,
+                _models.Task.id == association.c.task_id,
+            ).join(
+                depend,
+                depend.id == association.c.depend_id,
+            ).filter(
+                depend.state != "SUCCEED"
+            ),
+            task_ids,
+        )
+        for query in (parents, depends):
+            for task_id, blocker_id in query:
+                if task_id in blockers:
+                    blockers[task_id].add(blocker_id)
+
+        for task_id, task_blockers in blockers.items():
+            self._register(task_id, task_blockers)
+
+    def rebuild(self, session_factory):
+        """ drop everything and reload all PRERUN tasks """
+        self._pending.clear()
+        self._blocking.clear()
+        self._ready.clear()
+        self._parked.clear()
+        with _tm.manager:
+            session = _models.get_tm_session(session_factory, _tm.manager)
+            self._load(session)
+        _log.debug(
+            "Index rebuild: %d pending, %d ready",
+            len(self._pending),
+            len(self._ready),
+        )
+
+    def add(self, session_factory, task_ids):
+        """ (re)load the given tasks, e.g. after they were created """
+        if not task_ids:
+            return
+        with _tm.manager:
+            session = _models.get_tm_session(session_factory, _tm.manager)
+            self._load(session, task_ids)
+
+    def satisfied(self, blocker_id):
+        """ blocker (parent or dependency) reached SUCCEED """
+        for task_id in self._blocking.pop(blocker_id, ()):
+            blockers = self._pending.get(task_id)
+            if blockers is None:
+                continue
+            blockers.discard(blocker_id)
+            if not blockers:
+                del self._pending[task_id]
+                self._ready.add(task_id)
+
+    def unpark(self):
+        """ queue or script state changed, retry the parked tasks """
+        self._ready |= self._parked
+        self._parked.clear()
+
+    def park(self, task_id):
+        self._ready.discard(task_id)
+        self._parked.add(task_id)
+
+    def discard(self, task_id):
+        """ task was started or isn't PRERUN anymore """
+        self._forget(task_id)
+
+    def ready(self):
+        return set(self._ready)
+
+    def apply(self, session_factory, events):
+        """ update the index from scheduler notifications """
+        created = set()
+        for payload in events:
+            event, key = _models.parse_notify(payload)
+            if event == _models.NOTIFY_CREATED:
+                created.update(int(task_id) for task_id in key.split(','))
+            elif event == _models.NOTIFY_SUCCEED:
+                self.satisfied(int(key))
+            elif event == _models.NOTIFY_QUEUE:
+                self.unpark()
+        self.add(session_factory, created)
+
+
+def _start_batch(session_factory, config, index, candidates):
+    """ Claim and start a batch of ready tasks in one transaction
+
+    All tasks are published over one producer (and with it one broker
+    connection) and their ``run`` is stamped with a single UPDATE.
+
+    Returns:
+        list: ids of tasks which turned out to be still blocked
+    """
+    stale = []
+    started = []
     with _tm.manager:
         session = _models.get_tm_session(session_factory, _tm.manager)
-        tasks = session.query(
-            _models.Task
-        ).filter(
-            _models.Task.run.is_(None)
-        ).filter(
-            _models.Task.state == 'PRERUN'
-        ).all()
+        claimed = _claim(
+            _pending_tasks(session.query(_models.Task.id), candidates)
+        )
+        # not PRERUN anymore (started, deleted, ...) or claimed by another
+        # scheduler, the safety poll picks them up again if that one fails
+        for task_id in set(candidates).difference(claimed):
+            index.discard(task_id)
+        if not claimed:
+            return stale
+        tasks = _fail_unrunnable(session, _load_tasks(session, claimed))
+        for task_id in set(claimed).difference(task.id for task in tasks):
+            index.discard(task_id)
+
+        ready = []
         for task in tasks:
-            if not task.worker.is_active():
+            if task.queue_state != "active":
                 _log.warning(
                     "Queue {} is not active, can't start Task {} - {}".format(
-                        task.worker.name,
+                        task.queue_name,
                         task.id,
                         task.title,
                     )
                 )
+                index.park(task.id)
                 continue
 
-            if task.script.is_active:
+            if task.script_status != "ACTIVE":
                 _log.warning(
                     "QueueScript {} is not active, can't start Task {} - {}".format(
-                        task.script.name,
+                        task.script_name,
                         task.id,
                         task.title,
                     )
                 )
+                index.park(task.id)
                 continue
 
+            # the index might be stale, double check before starting
             if not _check_parent(task):
+                stale.append(task.id)
                 continue
 
             depends_state = [
-                (depend_task.id, depend_task.state)
-                for depend_task in task.depends
-                if depend_task.state != "SUCCEED"
+                (depend_id, depend_state)
+                for depend_id, depend_state in task.depends.items()
+                if depend_state != "SUCCEED"
             ]
             _log.info(
                 "Depends {} - {}".format(
                     depends_state,
-                    [
-                        (depend_task.id, depend_task.state)
-                        for depend_task in task.depends
-                    ],
+                    sorted(task.depends.items()),
                 )
             )
-            if not depends_state:
-                if task.script.is_script():
-                    task_run = _start_task(task, config)
-                elif task.script.is_function():
-                    task_run = _start_function(task, config)
+            if depends_state:
+                stale.append(task.id)
+                continue
+            ready.append(task)
+
+        with _views.celery_app.producer_or_acquire() as producer:
+            for task in ready:
+                if task.script_type == _models.Script.SCRIPT_TYPE:
+                    _start_task(task, config, producer)
+                elif task.script_type == _models.Script.FUNC_TYPE:
+                    _start_function(task, config, producer)
+                started.append(task.id)
+                index.discard(task.id)
 
-                if task.parent:
+                if task.parent_id:
                     log_str = "Start Task {} after parent {}".format(
                         task.id,
-                        task.parent.id,
+                        task.parent_id,
                     )
                     _log.info(log_str)
                 else:
                     _log.info(
                         "Start Task '{}' ({})".format(
                             task.id,
-                            task.script.type,
+                            task.script_type,
                         )
                     )
+        _stamp_run(session, started)
+
+    return stale
+
+
+def _handle_prerun_tasks(session_factory, config, index, batch_size):
+    candidates = sorted(index.ready())
+    stale = []
+    for offset in range(0, len(candidates), batch_size):
+        stale.extend(
+            _start_batch(
+                session_factory,
+                config,
+                index,
+                candidates[offset:offset + batch_size],
+            )
+        )
+    index.add(session_factory, stale)
+
+
+def _reconcile_counters(engine):
+    """ repair drift of the task state counters """
+    try:
+        if _models.reconcile_task_counters(engine):
+            _log.debug("Task counters reconciled")
+    except Exception as e:
+        _log.error("Reconciling task counters failed %r", e)
+
+
+def _compact(engine):
+    """ fold the insert-only delta rows the triggers write """
+    try:
+        _models.compact_table_versions(engine)
+        _models.compact_task_counters(engine)
+    except Exception as e:
+        _log.error("Compacting delta rows failed %r", e)
+
+
+def _listen(engine):
+    """ Open a connection listening on the scheduler channel
+
+    Returns None if the database doesn't support LISTEN/NOTIFY, in that
+    case the scheduler only polls.
+    """
+    if engine.dialect.name != 'postgresql':
+        _log.warning(
+            "LISTEN/NOTIFY not supported by %s, polling only",
+            engine.dialect.name,
+        )
+        return None
+    connection = engine.raw_connection()
+    connection.set_isolation_level(0)  # autocommit
+    cursor = connection.cursor()
+    cursor.execute("LISTEN {}".format(_models.SCHEDULER_CHANNEL))
+    cursor.close()
+    return connection
+
+
+def _wait_for_notify(connection, timeout):
+    """ Block until a notification arrives or timeout is reached
+
+    All pending notifications are consumed, one scan handles them all.
+
+    Returns:
+        list: payloads of the received notifications, empty on timeout
+    """
+    if connection is None:
+        _time.sleep(timeout)
+        return []
+
+    if not connection.notifies:
+        readable, _, _ = _select.select([connection], [], [], timeout)
+        if readable:
+            connection.poll()
+    events = [notify.payload for notify in connection.notifies]
+    if events:
+        _log.debug("Woken up by %s", events)
+    del connection.notifies[:]
+    return events
 
 
 @_click.command()
 @_click.argument('config', required=True)
 @_click.option(
     '--waittime',
-    default=10,
-    help='time to wait until check and start new tasks'
+    default=60,
+    help='max time to wait for a notification until check and start new tasks'
+)
+@_click.option(
+    '--batch-size',
+    default=100,
+    help='max number of tasks claimed and submitted in one transaction'
 )
-def scheduler(config, waittime):
+@_click.option(
+    '--reconcile-interval',
+    default=3600,
+    help='seconds between recounts of the task state counters, 0 disables '
+         'them (e.g. in all but one scheduler)'
+)
+@_click.option(
+    '--compact-interval',
+    default=60,
+    help='seconds between compactions of the table version and task '
+         'counter rows, 0 disables them'
+)
+def scheduler(config, waittime, batch_size, reconcile_interval, compact_interval):
     _paster.setup_logging(config)
     settings = _paster.get_appsettings(config)
 
     engine = _models.get_engine(settings)
     session_factory = _models.get_session_factory(engine)
+    listener = _listen(engine)
+    index = ReadinessIndex()
+    index.rebuild(session_factory)
+    rebuilt = _time.monotonic()
     _log.info("Scheduler up and running...")
+    reconciled = compacted = _time.monotonic()
     while True:
-        _handle_prerun_tasks(session_factory, config)
+        _handle_prerun_tasks(session_factory, config, index, batch_size)
         _handle_failed_tasks(session_factory, config)
-        _time.sleep(waittime)
+        if reconcile_interval and _time.monotonic() - reconciled > reconcile_interval:
+            _reconcile_counters(engine)
+            reconciled = _time.monotonic()
+        if compact_interval and _time.monotonic() - compacted > compact_interval:
+            _compact(engine)
+            compacted = _time.monotonic()
+        try:
+            events = _wait_for_notify(listener, waittime)
+        except Exception as e:
+            _log.error("Lost listen connection, reconnect... %r", e)
+            listener.invalidate()
+            listener = _listen(engine)
+            events = []
+            # notifications sent meanwhile are lost
+            rebuilt = None
+
+        if events:
+            index.apply(session_factory, events)
+        # safety poll, also under steady notifications: tasks of
+        # reactivated scripts (no notification), tasks claimed by a
+        # scheduler which rolled back, lost notifications
+        if rebuilt is None or _time.monotonic() - rebuilt >= waittime:
+            index.rebuild(session_factory)
+            rebuilt = _time.monotonic()
 
 
 def main(argv=tuple(_sys.argv)):
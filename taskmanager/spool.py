@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+import os as _os
+import threading as _threading
+
+STREAMS = ("stdout", "stderr")
+CHUNK_SIZE = 64 * 1024
+# size of the output tail which is returned through the result backend
+TAIL_SIZE = 64 * 1024
+TRUNCATED = b"\n[output truncated]\n"
+
+
+def output_path(spool_dir, task_id, attempt, stream):
+    """ path of the output of one run attempt of a task """
+    return _os.path.join(spool_dir, str(task_id), f"{attempt}.{stream}")
+
+
+class SpoolError(OSError):
+    """ output couldn't be spooled, ``tails`` holds what was read anyway """
+
+    def __init__(self, message, tails):
+        super().__init__(message)
+        self.tails = tails
+
+
+def _copy(pipe, path, max_size, tails, stream, errors):
+    """ copy pipe chunk by chunk into path, keep only the tail in memory
+
+    Writing stops at ``max_size`` bytes (if set) or at the first write
+    error (stored in ``errors``), the pipe is always drained to EOF so
+    the process doesn't block.
+    """
+    written = 0
+    truncated = False
+    tail = bytearray()
+    out = None
+    try:
+        out = open(path, 'wb')
+    except OSError as e:
+        errors[stream] = e
+    try:
+        for chunk in iter(lambda: pipe.read1(CHUNK_SIZE), b''):
+            tail += chunk
+            del tail[:-TAIL_SIZE]
+            if truncated or out is None:
+                continue
+            if max_size and written + len(chunk) > max_size:
+                chunk = chunk[:max_size - written]
+                truncated = True
+            try:
+                out.write(chunk)
+                written += len(chunk)
+                if truncated:
+                    out.write(TRUNCATED)
+                # readers tail the file while the task is running
+                out.flush()
+            except OSError as e:
+                errors[stream] = e
+                out.close()
+                out = None
+    finally:
+        if out is not None:
+            try:
+                out.close()
+            except OSError as e:
+                errors.setdefault(stream, e)
+    tails[stream] = bytes(tail)
+
+
+def capture(process, spool_dir, task_id, attempt, max_size=None):
+    """ Spool stdout and stderr of process until it exits
+
+    Returns:
+        dict: stream name -> last TAIL_SIZE bytes of the output
+
+    Raises:
+        SpoolError: after the process exited, if (some of) its output
+            couldn't be written
+    """
+    tails = {}
+    errors = {}
+    try:
+        _os.makedirs(_os.path.join(spool_dir, str(task_id)), exist_ok=True)
+    except OSError as e:
+        # _copy fails to open the files too and only drains the pipes
+        errors['spool_dir'] = e
+    threads = [
+        _threading.Thread(
+            target=_copy,
+            args=(
+                getattr(process, stream),
+                output_path(spool_dir, task_id, attempt, stream),
+                max_size,
+                tails,
+                stream,
+                errors,
+            ),
+        )
+        for stream in STREAMS
+    ]
+    for thread in threads:
+        thread.start()
+    process.wait()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise SpoolError(
+            f"Spooling output of task {task_id} failed: "
+            + ", ".join(f"{name}: {error}" for name, error in errors.items()),
+            tails,
+        )
+    return tails
+
+
+def remove_outputs(spool_dir, before):
+    """ Remove the spooled output of tasks not written since ``before``
+
+    Args:
+        before (float): POSIX timestamp
+
+    Returns:
+        int: number of removed task directories
+    """
+    removed = 0
+    try:
+        entries = list(_os.scandir(spool_dir))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        if not entry.is_dir(follow_symlinks=False) or not entry.name.isdigit():
+            continue
+        names = _os.listdir(entry.path)
+        paths = [_os.path.join(entry.path, name) for name in names]
+        if any(_os.path.getmtime(path) >= before for path in paths):
+            continue
+        for path in paths:
+            _os.remove(path)
+        _os.rmdir(entry.path)
+        removed += 1
+    return removed
+
+
+def latest_attempt(spool_dir, task_id):
+    """ highest spooled run attempt of a task, None if there is none """
+    try:
+        names = _os.listdir(_os.path.join(spool_dir, str(task_id)))
+    except FileNotFoundError:
+        return None
+    attempts = [
+        int(attempt)
+        for attempt, _, _stream in (name.partition('.') for name in names)
+        if attempt.isdigit()
+    ]
+    return max(attempts) if attempts else None
+
+
+def next_attempt(spool_dir, task_id):
+    """ number of a new run attempt, above all spooled ones
+
+    Celery's retry count starts at 0 again when the scheduler restarts a
+    failed task, it can't number the attempts.
+    """
+    latest = latest_attempt(spool_dir, task_id)
+    return 0 if latest is None else latest + 1
+
+
+def read(
+        spool_dir,
+        task_id,
+        stream="stdout",
+        attempt=None,
+        offset=0,
+        length=None,
+        tail=None,
+):
+    """ Read a byte range (or the last ``tail`` bytes) of spooled output
+
+    Returns:
+        dict: ``attempt``, ``offset`` of the returned data, current
+            ``size`` of the output and the raw ``data`` or None if there
+            is no output
+    """
+    if stream not in STREAMS:
+        raise ValueError(f"Unknown stream {stream!r}")
+    if attempt is None:
+        attempt = latest_attempt(spool_dir, task_id)
+        if attempt is None:
+            return None
+    path = output_path(spool_dir, task_id, attempt, stream)
+    try:
+        output = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    with output:
+        size = _os.fstat(output.fileno()).st_size
+        if tail is not None:
+            offset = max(size - tail, 0)
+        offset = min(offset, size)
+        output.seek(offset)
+        data = output.read(length if length is not None else -1)
+    return {
+        "attempt": attempt,
+        "offset": offset,
+        "size": size,
+        "data": data,
+    }
@@ -66,6 +66,217 @@ class TestWorker(BaseTest):
         self.assertEqual(info['data'], 'taskmanager')
 
 
+class TestReadinessIndex(unittest.TestCase):
+
+    def setUp(self):
+        from .scripts.task_scheduler import ReadinessIndex
+        self.index = ReadinessIndex()
+
+    def test_ready_without_blockers(self):
+        self.index._register(1, set())
+        self.assertEqual(self.index.ready(), {1})
+
+    def test_ready_after_all_blockers_succeed(self):
+        self.index._register(3, {1, 2})
+        self.index.satisfied(1)
+        self.assertEqual(self.index.ready(), set())
+        self.index.satisfied(2)
+        self.assertEqual(self.index.ready(), {3})
+
+    def test_reregister_ignores_old_blockers(self):
+        self.index._register(3, {1, 2})
+        self.index._register(3, {2})
+        self.index.satisfied(1)
+        self.assertEqual(self.index.ready(), set())
+
+    def test_park_and_unpark(self):
+        self.index._register(1, set())
+        self.index.park(1)
+        self.assertEqual(self.index.ready(), set())
+        self.index.unpark()
+        self.assertEqual(self.index.ready(), {1})
+
+
+class TestCursorLinks(unittest.TestCase):
+
+    def test_links(self):
+        from .views import create_cursor_links
+        links = create_cursor_links("/tasks", 20, 100, 120)
+        self.assertEqual(links["first"], "/tasks?page[after]=&page[size]=20")
+        self.assertEqual(links["next"], "/tasks?page[after]=100&page[size]=20")
+        self.assertEqual(links["prev"], "/tasks?page[before]=120&page[size]=20")
+
+    def test_no_further_pages(self):
+        from .views import create_cursor_links
+        links = create_cursor_links("/tasks", 20, None, None)
+        self.assertIsNone(links["next"])
+        self.assertIsNone(links["prev"])
+
+
+class TestWorkflowOrder(unittest.TestCase):
+
+    def test_parents_and_depends_first(self):
+        from .views.tasks import _workflow_order
+        nodes = [
+            {"ref": "report", "depends": ["load", 7]},
+            {"ref": "load", "parent_id": "extract"},
+            {"ref": "extract"},
+        ]
+        order = [node["ref"] for node in _workflow_order(nodes)]
+        self.assertEqual(order, ["extract", "load", "report"])
+
+    def test_cycle(self):
+        from .views import RestAPIException
+        from .views.tasks import _workflow_order
+        nodes = [
+            {"ref": "a", "depends": ["b"]},
+            {"ref": "b", "depends": ["a"]},
+            {"ref": "c"},
+        ]
+        with self.assertRaises(RestAPIException):
+            _workflow_order(nodes)
+
+    def test_unknown_ref(self):
+        from .views import RestAPIException
+        from .views.tasks import _workflow_order
+        with self.assertRaises(RestAPIException):
+            _workflow_order([{"ref": "a", "depends": ["missing"]}])
+
+
+class TestRenderers(unittest.TestCase):
+
+    def test_choose_encoding(self):
+        from .renderers import choose_encoding
+        self.assertEqual(choose_encoding("gzip, deflate"), "gzip")
+        self.assertEqual(choose_encoding("gzip;q=0, deflate"), None)
+        self.assertEqual(choose_encoding(None), None)
+
+    def test_dumps(self):
+        import datetime
+        from .renderers import dumps_stdlib
+        value = {"run": datetime.datetime(2020, 1, 2, 3, 4, 5)}
+        self.assertEqual(
+            _json.loads(dumps_stdlib(value)),
+            {"run": "2020-01-02T03:04:05"},
+        )
+
+
+class TestPartitions(unittest.TestCase):
+
+    def test_months(self):
+        import datetime
+        from .models import partitions
+        month = partitions.month_start(datetime.datetime(2020, 12, 24, 18))
+        self.assertEqual(month, datetime.datetime(2020, 12, 1))
+        self.assertEqual(
+            partitions.add_months(month, 1),
+            datetime.datetime(2021, 1, 1),
+        )
+        self.assertEqual(
+            partitions.add_months(month, -12),
+            datetime.datetime(2019, 12, 1),
+        )
+        self.assertEqual(partitions.partition_name(month), "task_log_y2020m12")
+
+
+class TestArchivable(unittest.TestCase):
+
+    def test_referenced_tasks_stay(self):
+        from .models.archive import _archivable
+        # 2 is parent of 3 (staying), 1 is dependency of 2
+        references = [(2, 3), (1, 2)]
+        self.assertEqual(_archivable([1, 2, 4], references), {4})
+        self.assertEqual(_archivable([1, 2, 3], references), {1, 2, 3})
+
+
+class TestMigrations(unittest.TestCase):
+
+    def test_names(self):
+        from .models.migrations import MIGRATIONS, index_names
+        names = [name for name, _statement, _concurrent in MIGRATIONS]
+        self.assertEqual(names, sorted(set(names)))
+        self.assertIn('ix_tasks_prerun', index_names())
+        self.assertEqual(len(index_names()), len(set(index_names())))
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.spool_dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _write(self, data, max_size=None):
+        import io
+        from .spool import _copy, output_path
+        import os
+        os.makedirs(os.path.join(self.spool_dir, "1"), exist_ok=True)
+        tails = {}
+        _copy(
+            io.BufferedReader(io.BytesIO(data)),
+            output_path(self.spool_dir, 1, 0, "stdout"),
+            max_size,
+            tails,
+            "stdout",
+            {},
+        )
+        return tails["stdout"]
+
+    def test_read_range_and_tail(self):
+        from .spool import read
+        self.assertEqual(self._write(b"0123456789"), b"0123456789")
+        output = read(self.spool_dir, 1, offset=2, length=3)
+        self.assertEqual(output["data"], b"234")
+        self.assertEqual(output["size"], 10)
+        self.assertEqual(output["attempt"], 0)
+        self.assertEqual(read(self.spool_dir, 1, tail=4)["data"], b"6789")
+
+    def test_max_size(self):
+        from .spool import read, TRUNCATED
+        self.assertEqual(self._write(b"0123456789", max_size=4), b"0123456789")
+        self.assertEqual(read(self.spool_dir, 1)["data"], b"0123" + TRUNCATED)
+
+    def test_no_output(self):
+        from .spool import read
+        self.assertIsNone(read(self.spool_dir, 2))
+
+    def test_next_attempt(self):
+        from .spool import next_attempt
+        self.assertEqual(next_attempt(self.spool_dir, 1), 0)
+        self._write(b"0123")
+        self.assertEqual(next_attempt(self.spool_dir, 1), 1)
+
+    def test_unwritable_is_drained(self):
+        import io
+        import os
+        from .spool import _copy, output_path
+        errors = {}
+        tails = {}
+        pipe = io.BufferedReader(io.BytesIO(b"x" * 200000))
+        _copy(
+            pipe,
+            output_path(os.path.join(self.spool_dir, "missing"), 1, 0, "stdout"),
+            None,
+            tails,
+            "stdout",
+            errors,
+        )
+        self.assertIn("stdout", errors)
+        self.assertEqual(pipe.read(), b"")
+        self.assertEqual(len(tails["stdout"]), 64 * 1024)
+
+    def test_remove_outputs(self):
+        import time
+        from .spool import remove_outputs, read
+        self._write(b"0123")
+        self.assertEqual(remove_outputs(self.spool_dir, time.time() - 60), 0)
+        self.assertEqual(remove_outputs(self.spool_dir, time.time() + 60), 1)
+        self.assertIsNone(read(self.spool_dir, 1))
+
+
 # class TestMyViewFailureCondition(BaseTest):
 
 #     def test_failing_view(self):
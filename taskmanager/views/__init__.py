@@ -7,20 +7,23 @@ import contextlib as _ct
 import transaction as _ta
 import subprocess as _subprocess
 import importlib as _importlib
+import time as _time
 import functools as _ft
 import collections as _collection
+import threading as _threading
+import hashlib as _hashlib
 
 import celery as _celery
 import celery.result as _result
-import celery.exceptions as _exceptions
 import celery.utils.log as _logging
 
 import pyramid.httpexceptions as _httpexceptions
+import pyramid.response as _response
 
-import psycopg2 as _psycopg2
-import sqlalchemy.orm as _orm
+import sqlalchemy as _sa
 
 import taskmanager.models as _models
+import taskmanager.spool as _spool
 
 _log = _logging.get_task_logger(__name__)
 
@@ -28,6 +31,9 @@ RESULT_OK = "OK"
 RESULT_ERROR = "ERROR"
 RESULT_NOTFOUND = "NOT_FOUND"
 
+# seconds clients may reuse near static responses (teams, scripts)
+STATIC_MAX_AGE = 60
+
 
 class RestAPIException(Exception):
     def __init__(self, message, error_type=RESULT_ERROR):
@@ -51,13 +57,150 @@ if celery_app is None:
     celery_app.conf.task_default_queue = 'default'
     celery_app.conf.task_queues = []
 
+# output of scripts is spooled here, must be shared by workers and API
+spool_config = cfg_parser['spool'] if cfg_parser.has_section('spool') else {}
+SPOOL_DIR = spool_config.get('path', '/tmp/taskmanager/spool')
+# max bytes spooled per stream and run, 0 for no limit
+SPOOL_MAX_SIZE = int(spool_config.get('max_size', 0))
+
 
 def get_result(task_id):
-    res = _result.AsyncResult(task_id, app=celery_app, timeout=300)
-    try:
-        return res.get()
-    except _exceptions.TimeoutError:
-        return {}
+    """ State and, if finished, result of a task, never blocks
+
+    Returns:
+        tuple: celery state and ``(return_code, stdout, stderr)`` or None
+            if the task isn't finished yet
+    """
+    res = _result.AsyncResult(task_id, app=celery_app)
+    if not res.ready():
+        return res.state, None
+    if res.failed():
+        return res.state, (-1, '', repr(res.result))
+    return res.state, res.result
+
+
+# requests waiting for tasks at the same time (long poll, events, output
+# follow), each holds a server thread, keep it below the server threads
+MAX_WAITERS = 2
+# seconds clients are asked to wait when all waiter slots are taken
+WAITERS_RETRY_AFTER = 5
+
+
+class ReleasingIter(object):
+    """ app_iter calling ``release`` once the server closes it, also if
+    the response was never iterated
+    """
+
+    def __init__(self, iterable, release):
+        self._iterable = iterable
+        self._release = release
+
+    def __iter__(self):
+        return iter(self._iterable)
+
+    def close(self):
+        try:
+            close = getattr(self._iterable, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            release, self._release = self._release, None
+            if release is not None:
+                release()
+
+
+class ResultWatcher(object):
+    """ Single thread waiting for tasks to finish on behalf of all clients
+
+    Instead of every request blocking on the result backend, waiting
+    requests park on an event. The watcher checks the states of all
+    awaited tasks with one query per ``interval`` and wakes up the
+    requests of finished tasks.
+    """
+    FINISHED = ("SUCCEED", "FAILED", "FAILED-ACKED", "DELETED")
+
+    def __init__(self, session_factory, interval=1.0, max_waiters=MAX_WAITERS):
+        self._session_factory = session_factory
+        self._interval = interval
+        self._lock = _threading.Lock()
+        self._waiting = {}  # task id -> [event, number of waiting clients]
+        self._thread = None
+        self._slots = _threading.BoundedSemaphore(max_waiters)
+
+    def acquire(self):
+        """ Reserve one of ``max_waiters`` slots for a waiting request
+
+        A waiting request holds a server thread, without a slot it has
+        to answer right away (e.g. 202 or 503 with Retry-After).
+
+        Returns:
+            bool: False if all slots are taken
+        """
+        return self._slots.acquire(blocking=False)
+
+    def release(self):
+        self._slots.release()
+
+    def wait(self, task_id, timeout):
+        """ Block until the task finished or timeout
+
+        Returns:
+            bool: True if the task finished
+        """
+        with self._lock:
+            entry = self._waiting.setdefault(
+                task_id,
+                [_threading.Event(), 0],
+            )
+            entry[1] += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = _threading.Thread(
+                    target=self._run,
+                    name="result-watcher",
+                    daemon=True,
+                )
+                self._thread.start()
+        try:
+            return entry[0].wait(timeout)
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] <= 0 and self._waiting.get(task_id) is entry:
+                    del self._waiting[task_id]
+
+    def _finished(self, task_ids):
+        session = self._session_factory()
+        try:
+            return [
+                task_id
+                for task_id, in session.query(
+                    _models.Task.id
+                ).filter(
+                    _models.Task.id.in_(task_ids)
+                ).filter(
+                    _models.Task.state.in_(self.FINISHED)
+                )
+            ]
+        finally:
+            session.close()
+
+    def _run(self):
+        while True:
+            _time.sleep(self._interval)
+            with self._lock:
+                task_ids = list(self._waiting)
+            if not task_ids:
+                continue
+            try:
+                finished = self._finished(task_ids)
+            except Exception as e:
+                _log.error("Result watcher failed %r", e)
+                continue
+            with self._lock:
+                for task_id in finished:
+                    entry = self._waiting.pop(task_id, None)
+                    if entry is not None:
+                        entry[0].set()
 
 
 @celery_app.task(retry_kwargs={'max_retries': 5})
@@ -80,15 +223,27 @@ def start_task(executable, config, options, additional_info=None):
             stdout=_subprocess.PIPE,
             stderr=_subprocess.PIPE,
         )
-        stdout, stderr = task.communicate()
+        # the full output is spooled, only its tail goes to the backend
+        try:
+            output = _spool.capture(
+                task,
+                SPOOL_DIR,
+                start_task.request.id,
+                _spool.next_attempt(SPOOL_DIR, start_task.request.id),
+                max_size=SPOOL_MAX_SIZE,
+            )
+        except _spool.SpoolError as e:
+            # the script did run, don't retry it because of the spool
+            _log.error("%s", e)
+            output = e.tails
         if task.returncode != 0:
             _log.info("retry...")
             start_task.retry()
         else:
             return (
                 task.returncode,
-                stdout.decode('utf-8'),
-                stderr.decode('utf-8'),
+                output["stdout"].decode('utf-8', errors='replace'),
+                output["stderr"].decode('utf-8', errors='replace'),
             )
     except Exception as e:
         _log.error("Something happen .... retry... %r", e)
@@ -122,21 +277,29 @@ def start_function(function, config, args, additional_info=None):
 
 @_ct.contextmanager
 def dbsession(request):
-    settings = request.registry.settings
-    engine = _models.get_engine(settings)
-    session_factory = _models.get_session_factory(engine)
-    db_session = _orm.scoped_session(session_factory)
-    yield db_session
-    db_session.remove()
-    engine.dispose()
-    # with _ta.manager:
-    #     yield _models.get_tm_session(session_factory, _ta.manager)
+    """ Request scoped session from the pooled session factory
+
+    The engine and session factory are created once in
+    ``taskmanager.models.includeme`` and stored in the registry, closing
+    the session only returns the connection to the pool.
+    """
+    session_factory = request.registry['dbsession_factory']
+    db_session = session_factory()
+    try:
+        yield db_session
+    finally:
+        db_session.close()
 
 
 @_ct.contextmanager
 def get_connection(request):
-    settings = request.registry.settings
-    yield _psycopg2.connect(settings['sqlalchemy.url'])
+    """ Raw DBAPI connection borrowed from the pool """
+    engine = request.registry['dbsession_engine']
+    connection = engine.raw_connection()
+    try:
+        yield connection
+    finally:
+        connection.close()
 
 
 def create_links(base_url, page, max_entries, max_elements):
@@ -153,6 +316,45 @@ def create_links(base_url, page, max_entries, max_elements):
     }
 
 
+def create_cursor_links(base_url, max_entries, after, before):
+    """ links for keyset pagination, ``after``/``before`` are row ids
+
+    ``next``/``prev`` are None if there is no further page in that
+    direction. ``first`` starts at the newest row (``page[after]=``).
+    """
+    base_unformat_url = "{}?page[{}]={}&page[size]={}"
+    first = base_unformat_url.format(base_url, "after", "", max_entries)
+    return {
+        "first": first,
+        "next": (
+            base_unformat_url.format(base_url, "after", after, max_entries)
+            if after is not None else None
+        ),
+        "prev": (
+            base_unformat_url.format(base_url, "before", before, max_entries)
+            if before is not None else None
+        ),
+    }
+
+
+def estimate_count(session, table):
+    """ Cheap row count estimate of a whole table from the statistics
+
+    Returns None if the database doesn't offer one.
+    """
+    if session.bind.dialect.name != 'postgresql':
+        return None
+    estimate = session.execute(
+        _sa.text(
+            "SELECT reltuples::bigint FROM pg_class WHERE relname = :table"
+        ),
+        {"table": table},
+    ).scalar()
+    if estimate is None or estimate < 0:
+        return None
+    return estimate
+
+
 class BaseResource(object):
     NAME = None
 
@@ -230,6 +432,88 @@ class BaseResource(object):
             handler(config, method)
 
 
+def _etag(request, tables):
+    """ weak ETag of the requested URL for the current ``tables`` versions
+
+    None if the database doesn't track table versions.
+    """
+    with dbsession(request) as session:
+        versions = _models.table_versions(session, tables)
+    if versions is None:
+        return None
+    key = repr((versions, request.path_qs, _os.environ.get('JSONAPI')))
+    return _hashlib.md5(key.encode()).hexdigest()
+
+
+# schema instances per thread, marshmallow(-jsonapi) keeps the state of a
+# dump/load (errors, included data) on the instance
+_schema_cache = _threading.local()
+# schema instances kept per thread, least recently used ones are dropped
+MAX_SCHEMAS = 64
+
+
+def _normalize(names):
+    """ include/only names as cache key, order and duplicates don't matter """
+    if names is None or isinstance(names, bool):
+        return names
+    return tuple(sorted(set(names)))
+
+
+def get_schema(schema, many=False, include_data=None, only=None):
+    """ Reuse a schema instance per (schema, many, include, only) combination
+
+    Building a schema binds and copies all its fields, which costs about
+    as much as dumping a page of tasks.
+    """
+    cache = getattr(_schema_cache, 'cache', None)
+    if cache is None:
+        cache = _schema_cache.cache = _collection.OrderedDict()
+    include_data = _normalize(include_data)
+    only = _normalize(only)
+    key = (schema, many, include_data, only)
+    instance = cache.get(key)
+    if instance is None:
+        kwargs = {'many': many}
+        if include_data is not None:
+            kwargs['include_data'] = include_data
+        if only is not None:
+            kwargs['only'] = only
+        instance = cache[key] = schema(**kwargs)
+        while len(cache) > MAX_SCHEMAS:
+            cache.popitem(last=False)
+    else:
+        cache.move_to_end(key)
+    if hasattr(instance, 'included_data'):
+        instance.included_data = {}
+    return instance
+
+
+def _schema_type(schema):
+    """ JSON:API type of a schema, the key of its ``fields[...]`` param """
+    return getattr(getattr(schema, 'Meta', None), 'type_', None)
+
+
+def sparse_fields(schema, names):
+    """ Schema attributes for the field names of a ``fields[type]`` param
+
+    Names may be given as dumped (``scheduledBy``) or as attribute,
+    ``id`` is always part of the result.
+
+    Raises:
+        HTTPBadRequest: for names the schema doesn't have
+    """
+    attributes = {}
+    for name, field in schema._declared_fields.items():
+        attributes[name] = name
+        attributes[field.dump_to or name] = name
+    unknown = [name for name in names if name not in attributes]
+    if unknown:
+        raise _httpexceptions.HTTPBadRequest(
+            f"Unknown fields {unknown} for {_schema_type(schema)}"
+        )
+    return tuple(sorted({'id'} | {attributes[name] for name in names}))
+
+
 def _wrap_func(func):
     if func.__resource__.get('wrapped'):
         return func
@@ -244,24 +528,67 @@ def _wrap_func(func):
         req = self.request
         kwargs.update(req.matchdict)
         include_data = False
+        sparse = {}
+        include = None
         for key, value in req.params.items():
+            if key == "page[after]":
+                # an empty cursor starts keyset pagination at the beginning
+                kwargs["after"] = int(value) if value else 0
+                continue
             if not value:
                 continue
             if key == "page[number]":
                 kwargs["page"] = int(value)
             elif key == "page[size]":
                 kwargs["size"] = int(value)
+            elif key == "page[before]":
+                kwargs["before"] = int(value)
+            elif key == "page[count]":
+                kwargs["with_count"] = value == "exact"
             elif key == 'include_data':
                 include_data = True
                 continue
+            elif key.startswith("fields[") and key.endswith("]"):
+                sparse[key[len("fields["):-1]] = tuple(
+                    name for name in value.split(",") if name
+                )
+            elif key == "include":
+                include = tuple(name for name in value.split(",") if name)
             else:
                 kwargs[key] = value
+        etag_tables = resource.get('etag_tables')
+        live = any(kwargs.get(name) for name in resource.get('etag_live', ()))
+        if etag_tables and req.method == 'GET' and not live:
+            etag = _etag(req, etag_tables)
+            max_age = resource.get('max_age')
+            headers = {
+                'Cache-Control': f'max-age={max_age}' if max_age else 'no-cache',
+            }
+            if etag is not None:
+                headers['ETag'] = f'W/"{etag}"'
+                if etag in req.if_none_match:
+                    return _httpexceptions.HTTPNotModified(headers=headers)
+            for name, value in headers.items():
+                req.response.headers[name] = value
+
         input_schema = resource.get('input_model')
         output_schema = resource.get('output_model')
 
+        only = None
+        if output_schema and _schema_type(output_schema) in sparse:
+            only = sparse_fields(
+                output_schema,
+                sparse[_schema_type(output_schema)] + tuple(
+                    name.split(".")[0] for name in include or ()
+                ),
+            )
+        if resource.get('with_fields'):
+            kwargs['fields'] = only
+            kwargs['include'] = include
+
         if input_schema:
             input_data = req.json
-            input_data = input_schema().load(input_data).data
+            input_data = get_schema(input_schema).load(input_data).data
             kwargs.update({'post_data': input_data})
         try:
             _log.debug(dict(req.params))
@@ -275,6 +602,9 @@ def _wrap_func(func):
             raise _httpexceptions.HTTPNotFound(
                 "Couldn't find object"
             )
+        if isinstance(data, _response.Response):
+            # e.g. streamed responses, nothing to serialize
+            return data
         with_links = resource.get('with_links')
         result = {}
 
@@ -289,21 +619,38 @@ def _wrap_func(func):
             meta = data['meta']
             data = data['data']
             result["meta"] = {"count": meta["max_elements"]}
-            result["links"] = create_links(
-                req.route_url(resource.get("name")),
-                **meta,
-            )
+            if 'cursor' in meta:
+                result["links"] = create_cursor_links(
+                    req.route_url(resource.get("name")),
+                    meta["max_entries"],
+                    **meta['cursor'],
+                )
+            else:
+                result["links"] = create_links(
+                    req.route_url(resource.get("name")),
+                    **meta,
+                )
 
         attr = {'many': False}
         if isinstance(data, _collection.Iterable):
             attr['many'] = True
 
-        if include_data and json_api:
+        if include is not None and json_api:
+            # only what the resource allows to be included
+            attr['include_data'] = tuple(
+                name
+                for name in include
+                if name in (resource.get('include') or ())
+            )
+            result['json_api'] = True
+        elif include_data and json_api:
             attr['include_data'] = resource.get('include')
             result['json_api'] = True
+        if only is not None:
+            attr['only'] = only
 
         if output_schema:
-            data = output_schema(**attr).dump(data)
+            data = get_schema(output_schema, **attr).dump(data)
         if not 'data' in data:
             data = {'data': data}
         result.update(data)
@@ -405,3 +752,34 @@ def with_links(func):
     func.__resource__ = func.__dict__.get('__resource__', {})
     func.__resource__.setdefault('with_links', True)
     return _wrap_func(func)
+
+
+def with_etag(*tables, max_age=None, live=()):
+    """ decorator for conditional GET
+
+    The ETag is derived from the change versions of ``tables`` (everything
+    the response is built from) and the URL. A matching ``If-None-Match``
+    is answered with 304 before the view runs. ``max_age`` allows clients
+    to reuse near static responses without asking at all. Requests with
+    one of the ``live`` params are built from other sources (e.g. celery
+    inspect) and get no ETag.
+    """
+    def wrapper(func):
+        func.__resource__ = func.__dict__.get('__resource__', {})
+        func.__resource__.setdefault('etag_tables', tables)
+        func.__resource__.setdefault('max_age', max_age)
+        func.__resource__.setdefault('etag_live', live)
+        return _wrap_func(func)
+    return wrapper
+
+
+def with_fields(func):
+    """ decorator for views honoring ``fields[type]=`` and ``include=``
+
+    The view gets ``fields`` (schema attributes to dump, None for all)
+    and ``include`` (requested relationships, None if not given) to only
+    select and load what is dumped.
+    """
+    func.__resource__ = func.__dict__.get('__resource__', {})
+    func.__resource__.setdefault('with_fields', True)
+    return _wrap_func(func)
@@ -15,6 +15,7 @@ class WorkerQueues(_views.BaseResource):
     @_views.get_all()
     @_views.with_model(output_model=_schemas.WorkerQueue)
     @_views.with_links
+    @_views.with_etag('worker_queues', 'workers', live=('worker_id',))
     def get_all(self, worker_id=None, page=0, size=20):
         queue_names = None
         with _views.dbsession(self.request) as session:
@@ -78,6 +79,7 @@ class WorkerQueues(_views.BaseResource):
 
     @_views.get_one(param="worker_queue_id")
     @_views.with_model(output_model=_schemas.WorkerQueue)
+    @_views.with_etag('worker_queues', 'workers')
     def get_one(self, worker_queue_id):
         with _views.dbsession(self.request) as session:
             queue = session.query(
@@ -105,6 +107,12 @@ class WorkerQueues(_views.BaseResource):
                     _views.RESULT_NOTFOUND
                 )
             queue.name = queue_name
+            if queue.state != state and state == "active":
+                _models.notify_scheduler(
+                    session,
+                    _models.NOTIFY_QUEUE,
+                    queue.name,
+                )
             queue.state = state
             session.commit()
             session.refresh(queue)
@@ -116,6 +124,7 @@ class WorkerNameQueue(_views.BaseResource):
 
     @_views.get_all()
     @_views.with_model(output_model=_schemas.WorkerQueue)
+    @_views.with_etag('worker_queues', 'workers')
     def get_one(self, name):
         with _views.dbsession(self.request) as session:
             queue = session.query(
@@ -17,6 +17,7 @@ class Scripts(_views.BaseResource):
     @_views.get_all()
     @_views.with_model(output_model=_schemas.Script, include=("team",))
     @_views.with_links
+    @_views.with_etag('scripts', 'teams', max_age=_views.STATIC_MAX_AGE)
     def get_all(self, team_id=None, include_data=None, page=0, size=20):
         with _views.dbsession(self.request) as session:
             scripts = session.query(
@@ -80,6 +81,7 @@ class Scripts(_views.BaseResource):
 
     @_views.get_one(param="script_id")
     @_views.with_model(output_model=_schemas.Script, include=("team",))
+    @_views.with_etag('scripts', 'teams', max_age=_views.STATIC_MAX_AGE)
     def get_script(self, script_id, include_data=None):
         with _views.dbsession(self.request) as session:
             script = session.query(
@@ -146,6 +148,7 @@ class ScriptName(_views.BaseResource):
 
     @_views.get_one(description="get name of script", param="script_name")
     @_views.with_model(output_model=_schemas.Script)
+    @_views.with_etag('scripts', 'teams', max_age=_views.STATIC_MAX_AGE)
     def get_script(self, script_name, include_data=False, **kwargs):
         additional = {}
         if include_data:
@@ -1,15 +1,40 @@
 # -*- coding: utf-8 -*-
 
+import io as _io
+import csv as _csv
+import json as _json
 import logging as _logging
+import datetime as _dt
+import time as _time
+import collections as _collections
 
+import celery.states as _celery_states
+
+import pyramid.httpexceptions as _httpexceptions
+import pyramid.response as _response
+
+import sqlalchemy as _sa_core
 import sqlalchemy.orm as _sa
 
+import taskmanager.spool as _spool
 import taskmanager.views as _views
 import taskmanager.models as _models
 import taskmanager.models.schemas as _schemas
 
 _log = _logging.getLogger(__name__)
 
+# everything a serialized task is built from, see ``_views.with_etag``
+_TASK_TABLES = (
+    'tasks',
+    'task_dependencies',
+    'task_log',
+    'tasks_archive',
+    'scripts',
+    'teams',
+    'worker_queues',
+    'workers',
+)
+
 
 def get_worker(worker_id, session, use_default_worker=False):
     """ Helper function to get worker by name
@@ -81,6 +106,317 @@ def get_states(state_filter):
     return lookup.get(state_filter, [state_filter])
 
 
+def _split(value):
+    """ comma separated query parameter as list """
+    if isinstance(value, str):
+        return [item for item in value.split(",") if item]
+    return value
+
+
+def _filter_tasks(session, tasks, state_filter, script, worker, team, model=_models.Task):
+    """ Apply the filters of the task list to a query on tasks
+
+    ``script`` (names) and ``worker`` (ids) may be comma separated,
+    ``model`` is ``Task`` or ``TaskArchive``.
+
+    Returns:
+        tuple: the filtered query and whether any filter was applied
+    """
+    filtered = False
+    if state_filter:
+        filtered = True
+        tasks = tasks.filter(
+            model.state.in_(state_filter)
+        )
+    if script:
+        filtered = True
+        script_obj = get_script(_split(script), session)
+        script_ids = [script.id for script in script_obj]
+        if script_obj:
+            tasks = tasks.filter(
+                model.script_id.in_(script_ids)
+            )
+    if worker:
+        filtered = True
+        worker = [int(worker_id) for worker_id in _split(worker)]
+        tasks = tasks.filter(
+            model.worker_id.in_(worker)
+        )
+    if team:
+        filtered = True
+        scripts = get_scripts(team, session)
+        tasks = tasks.filter(
+            model.script_id.in_(
+                tuple(script.id for script in scripts))
+        )
+    return tasks, filtered
+
+
+# columns the relationship fields of ``Tasks`` need besides the related rows
+_TASK_RELATIONS = {
+    'script': ('script_id',),
+    'worker': ('worker_id',),
+    'parent': ('parent_id',),
+    'depends': (),
+    'children': (),
+    'logs': (),
+}
+
+
+def _task_loads(fields=None, include=None, model=_models.Task):
+    """ Loader options for everything the ``Tasks`` schema dumps
+
+    Everything has to be loaded before the session is closed, the schema
+    is dumped afterwards. Collections get one extra query each instead of
+    a join, so the rows of a page don't multiply.
+
+    With ``fields`` (sparse fieldset) only these columns and the
+    relationships among them or in ``include`` are loaded.
+    """
+    task = model
+    loads = {
+        'script': _sa.joinedload(task.script).joinedload(_models.Script.team),
+        'worker': _sa.joinedload(task.worker),
+        'parent': _sa.joinedload(task.parent),
+        'depends': _sa.selectinload(task.depends),
+        'children': _sa.selectinload(task.children),
+        'logs': _sa.selectinload(task.logs),
+    }
+    if fields is None:
+        return tuple(loads.values())
+
+    wanted = {name for name in fields if name in _TASK_RELATIONS}
+    wanted.update(name.split(".")[0] for name in include or ())
+    columns = {'id'}
+    columns.update(name for name in fields if name not in _TASK_RELATIONS)
+    options = []
+    for name, load in loads.items():
+        if name in wanted:
+            columns.update(_TASK_RELATIONS[name])
+            options.append(load)
+        else:
+            options.append(_sa.noload(getattr(task, name)))
+    return (_sa.load_only(*columns),) + tuple(options)
+
+
+def _keyset_page(query, size, after=None, before=None, options=None, model=_models.Task):
+    """ One page of tasks (id desc) after or before the given task id
+
+    One row more than requested is fetched to know if there is a
+    further page.
+
+    Returns:
+        tuple: tasks of the page and the ``after``/``before`` cursors
+            for the next and previous page (None if there is none)
+    """
+    if before:
+        # walk backwards (ascending) and flip the page afterwards
+        query = query.filter(
+            model.id > before
+        ).order_by(
+            model.id.asc()
+        )
+    else:
+        if after:
+            query = query.filter(
+                model.id < after
+            )
+        query = query.order_by(
+            model.id.desc()
+        )
+    # limit on the ids, the joined eager loads multiply the rows
+    ids = [
+        task_id
+        for task_id, in query.with_entities(model.id).limit(size + 1)
+    ]
+    more = len(ids) > size
+    ids = ids[:size]
+    if before:
+        ids.reverse()
+    tasks = query.session.query(
+        model
+    ).filter(
+        model.id.in_(ids)
+    ).order_by(
+        model.id.desc()
+    ).options(
+        *(options if options is not None else _task_loads(model=model))
+    ).all()
+
+    has_next = more if not before else bool(ids)
+    has_prev = more if before else bool(after) and bool(ids)
+    cursor = {
+        'after': ids[-1] if ids and has_next else None,
+        'before': ids[0] if ids and has_prev else None,
+    }
+    return tasks, cursor
+
+
+# task ids per scheduler notification, the payload is limited to 8000 bytes
+NOTIFY_IDS = 500
+
+
+def _allocate_ids(session, count):
+    """ Reserve ``count`` task ids with one query
+
+    Returns None if the database has no sequence to draw from, the ids
+    are assigned on insert then.
+    """
+    if session.bind.dialect.name != 'postgresql':
+        return None
+    return [
+        task_id
+        for task_id, in session.execute(
+            _sa_core.text(
+                "SELECT nextval('tasks_id_seq') FROM generate_series(1, :count)"
+            ),
+            {"count": count},
+        )
+    ]
+
+
+def _notify_created(session, task_ids):
+    """ tell the scheduler about new tasks, many ids per notification """
+    for start in range(0, len(task_ids), NOTIFY_IDS):
+        _models.notify_scheduler(
+            session,
+            _models.NOTIFY_CREATED,
+            ",".join(str(task_id) for task_id in task_ids[start:start + NOTIFY_IDS]),
+        )
+
+
+def _create_tasks(session, items):
+    """ Validate and insert many tasks in the current transaction
+
+    ``items`` are dicts like the ``TaskBatchItem`` schema. ``depends``
+    and ``parent_id`` take ids of existing tasks or the ``ref`` of an
+    item earlier in the list. Scripts and queues are looked up once for
+    all items, tasks and dependencies are written with bulk inserts.
+
+    Returns:
+        list: ids of the new tasks, in the order of items
+
+    Raises:
+        HTTPBadRequest: on duplicate or unknown refs and ids of tasks
+            which don't exist
+    """
+    script_ids = {item["script"] for item in items}
+    worker_ids = {item["worker"] for item in items}
+    scripts = {
+        script.id: script
+        for script in session.query(
+            _models.Script
+        ).filter(
+            _models.Script.id.in_(script_ids)
+        )
+    }
+    workers = {
+        worker_id
+        for worker_id, in session.query(
+            _models.WorkerQueue.id
+        ).filter(
+            _models.WorkerQueue.id.in_(worker_ids)
+        )
+    }
+    for script_id in script_ids:
+        if script_id not in scripts:
+            raise _views.RestAPIException(
+                f"Couldn't find script {script_id}",
+                _views.RESULT_ERROR,
+            )
+        if not scripts[script_id].is_active:
+            raise _views.RestAPIException(
+                f"Script {script_id} is not ACTIVE",
+                _views.RESULT_ERROR,
+            )
+    missing = worker_ids - workers
+    if missing:
+        raise _views.RestAPIException(
+            f"Couldn't find worker {sorted(missing)}",
+            _views.RESULT_ERROR,
+        )
+
+    referenced = {
+        int(value)
+        for item in items
+        for value in [item.get("parent_id")] + list(item.get("depends", []))
+        if value is not None and not isinstance(value, str)
+    }
+    if referenced:
+        existing = {
+            task_id
+            for task_id, in session.query(
+                _models.Task.id
+            ).filter(
+                _models.Task.id.in_(referenced)
+            )
+        }
+        missing = referenced - existing
+        if missing:
+            raise _httpexceptions.HTTPBadRequest(
+                f"Couldn't find tasks {sorted(missing)}"
+            )
+
+    task_ids = _allocate_ids(session, len(items))
+    created = []
+    refs = {}
+
+    def resolve(value, position):
+        if not isinstance(value, str):
+            return int(value)
+        if value not in refs:
+            raise _httpexceptions.HTTPBadRequest(
+                f"Task {position}: unknown reference {value!r}, "
+                "references must point to earlier tasks"
+            )
+        return refs[value]
+
+    tasks = []
+    depends = []
+    for position, item in enumerate(items):
+        options = dict(item.get("options") or {})
+        if item.get("use_default_opt"):
+            options.update(scripts[item["script"]].default_options or {})
+        parent_id = item.get("parent_id")
+        row = {
+            "title": item.get("title"),
+            "script_id": item["script"],
+            "worker_id": item["worker"],
+            "parent_id": (
+                resolve(parent_id, position)
+                if parent_id is not None else None
+            ),
+            "state": "PRERUN",
+            "options": options,
+            "scheduled_by": item.get("scheduled_by", ""),
+        }
+        if task_ids is None:
+            task = _models.Task(**row)
+            session.add(task)
+            session.flush()
+            task_id = task.id
+        else:
+            task_id = row["id"] = task_ids[position]
+            tasks.append(row)
+        created.append(task_id)
+        if item.get("ref") is not None:
+            if item["ref"] in refs:
+                raise _httpexceptions.HTTPBadRequest(
+                    f"Task {position}: duplicate reference {item['ref']!r}"
+                )
+            refs[item["ref"]] = task_id
+        depends.extend(
+            {"task_id": task_id, "depend_id": resolve(depend, position)}
+            for depend in item.get("depends", [])
+        )
+
+    session.bulk_insert_mappings(_models.Task, tasks)
+    if depends:
+        session.execute(_models.association_table.insert(), depends)
+    _notify_created(session, created)
+    return created
+
+
 class Tasks(_views.BaseResource):
     NAME = "tasks"
 
@@ -136,13 +472,18 @@ class Tasks(_views.BaseResource):
                 scheduled_by=scheduled_by,
             )
             session.add(task)
-            session.commit()
+            session.flush()
             for depend in depends:
                 task_depend = _models.TaskDepends(
                     task.id,
                     int(depend),
                 )
                 session.add(task_depend)
+            _models.notify_scheduler(
+                session,
+                _models.NOTIFY_CREATED,
+                task.id,
+            )
             session.commit()
 
             return task
@@ -150,7 +491,26 @@ class Tasks(_views.BaseResource):
     @_views.get_all()
     @_views.with_model(output_model=_schemas.Tasks, include=("script", "worker", "script.team", "depends"))
     @_views.with_links
-    def get_tasks(self, state="ALL", page=0, size=20, script=None, worker=None, team=None, include_data=None):
+    @_views.with_etag(*_TASK_TABLES)
+    @_views.with_fields
+    def get_tasks(self, state="ALL", page=0, size=20, script=None, worker=None, team=None, include_data=None, after=None, before=None, with_count=None, fields=None, include=None, archive=None):
+        """ tasks ordered by id desc
+
+        ``page[number]`` pages with offsets. ``page[after]=<id>`` and
+        ``page[before]=<id>`` page by id (keyset pagination) instead,
+        which doesn't get slower on deep pages; an empty ``page[after]``
+        starts at the newest task. In this mode the count is only
+        exact with ``page[count]=exact``, otherwise it is an estimate
+        for unfiltered lists and null for filtered ones.
+
+        ``fields[tasks]=id,state,title`` selects, loads and dumps only
+        these fields, ``include=`` the relationships to load (and to
+        include with JSONAPI).
+
+        ``archive=1`` lists the archived tasks instead.
+        """
+        model = _models.TaskArchive if archive else _models.Task
+        loads = _task_loads(fields, include, model)
         max_entries = int(size)
         state_filter = get_states(state)
         _log.debug(f"Params: {self.request.params}")
@@ -159,33 +519,44 @@ class Tasks(_views.BaseResource):
         _log.debug(f"max_entries {max_entries}")
         _log.debug(f"script {script}")
         with _views.dbsession(self.request) as session:
-            tasks = session.query(
-                _models.Task
+            tasks, filtered = _filter_tasks(
+                session,
+                session.query(model),
+                state_filter,
+                script,
+                worker,
+                team,
+                model,
             )
-            if state_filter:
-                tasks = tasks.filter(
-                    _models.Task.state.in_(state_filter)
-                )
-            if script:
-                script_obj = get_script(script, session)
-                script_ids = [script.id for script in script_obj]
-                if script_obj:
-                    tasks = tasks.filter(
-                        _models.Task.script_id.in_(script_ids)
+            if after is not None or before is not None:
+                if with_count:
+                    max_elements = tasks.count()
+                elif not filtered:
+                    max_elements = _views.estimate_count(
+                        session,
+                        model.__tablename__,
                     )
-            if worker:
-                worker = [int(worker_id) for worker_id in worker]
-                tasks = tasks.filter(
-                    _models.Task.worker_id.in_(worker)
-                )
-            if team:
-                scripts = get_scripts(team, session)
-                tasks = tasks.filter(
-                    _models.Task.script_id.in_(
-                        tuple(script.id for script in scripts))
+                else:
+                    max_elements = None
+                tasks, cursor = _keyset_page(
+                    tasks,
+                    max_entries,
+                    after,
+                    before,
+                    options=loads,
+                    model=model,
                 )
+                return {
+                    'meta': {
+                        'max_entries': max_entries,
+                        'max_elements': max_elements,
+                        'cursor': cursor,
+                    },
+                    'data': tasks,
+                }
+
             query = tasks.order_by(
-                _models.Task.id.desc()
+                model.id.desc()
             )
             max_elements = query.count()
             _log.debug("offset : {offset}".format(offset=page*max_entries))
@@ -193,9 +564,7 @@ class Tasks(_views.BaseResource):
                 page*max_entries
             ).limit(
                 max_entries
-            ).options(_sa.joinedload('*')).all()
-            # TODO: Hack
-            _schemas.Tasks(many=True).dumps(tasks)
+            ).options(*loads).all()
             return {
                 'meta': {
                     'page': page,
@@ -207,18 +576,25 @@ class Tasks(_views.BaseResource):
 
     @_views.get_one(param="task_id")
     @_views.with_model(output_model=_schemas.Tasks, include=("script", "worker",))
-    def get_one(self, task_id, include_data=None):
+    @_views.with_etag(*_TASK_TABLES)
+    @_views.with_fields
+    def get_one(self, task_id, include_data=None, fields=None, include=None):
+        """ task by id, archived tasks are looked up if it isn't active """
         with _views.dbsession(self.request) as session:
-            task = session.query(
-                _models.Task
-            ).get(task_id)
+            task = None
+            for model in (_models.Task, _models.TaskArchive):
+                task = session.query(
+                    model
+                ).options(
+                    *_task_loads(fields, include, model)
+                ).get(task_id)
+                if task is not None:
+                    break
             if task is None:
                 raise _views.RestAPIException(
                     f"Task with id {task_id} not found",
                     _views.RESULT_NOTFOUND,
                 )
-            # TODO: Hack
-            _schemas.Tasks().dumps(task)
             return task
 
     @_views.patch_one(param="task_id")
@@ -267,11 +643,122 @@ class Tasks(_views.BaseResource):
             return task
 
 
+class TaskBatch(_views.BaseResource):
+    NAME = "tasks/batch"
+
+    @_views.post_one()
+    @_views.with_model(input_model=_schemas.TaskBatch)
+    def post_tasks(self, post_data):
+        """ create many tasks in one transaction, returns their ids """
+        items = post_data.get("tasks", [])
+        if not items:
+            raise _views.RestAPIException(
+                "No tasks given",
+                _views.RESULT_ERROR,
+            )
+        with _views.dbsession(self.request) as session:
+            task_ids = _create_tasks(session, items)
+            session.commit()
+        return {
+            "result": _views.RESULT_OK,
+            "data": {
+                "ids": task_ids,
+            },
+        }
+
+
+def _workflow_order(nodes):
+    """ Sort workflow nodes so parents and dependencies come first
+
+    Nodes reference each other by ``ref`` in ``parent_id`` and
+    ``depends``, other values are ids of existing tasks.
+
+    Raises:
+        RestAPIException: on duplicate or unknown refs and on cycles
+    """
+    by_ref = {}
+    for node in nodes:
+        if node["ref"] in by_ref:
+            raise _views.RestAPIException(
+                f"Duplicate node {node['ref']!r}",
+                _views.RESULT_ERROR,
+            )
+        by_ref[node["ref"]] = node
+
+    waiting_for = {}
+    dependents = _collections.defaultdict(list)
+    for node in nodes:
+        refs = [
+            value
+            for value in [node.get("parent_id")] + list(node.get("depends", []))
+            if isinstance(value, str)
+        ]
+        for value in refs:
+            if value not in by_ref:
+                raise _views.RestAPIException(
+                    f"Node {node['ref']!r}: unknown node {value!r}",
+                    _views.RESULT_ERROR,
+                )
+            dependents[value].append(node["ref"])
+        waiting_for[node["ref"]] = len(refs)
+
+    ordered = []
+    ready = _collections.deque(
+        node["ref"] for node in nodes if not waiting_for[node["ref"]]
+    )
+    while ready:
+        ref = ready.popleft()
+        ordered.append(by_ref[ref])
+        for dependent in dependents[ref]:
+            waiting_for[dependent] -= 1
+            if not waiting_for[dependent]:
+                ready.append(dependent)
+
+    if len(ordered) != len(nodes):
+        cycle = sorted(ref for ref, count in waiting_for.items() if count)
+        raise _views.RestAPIException(
+            f"Workflow has a cycle between {cycle}",
+            _views.RESULT_ERROR,
+        )
+    return ordered
+
+
+class TaskWorkflow(_views.BaseResource):
+    NAME = "tasks/workflow"
+
+    @_views.post_one()
+    @_views.with_model(input_model=_schemas.TaskWorkflow)
+    def post_workflow(self, post_data):
+        """ create a DAG of tasks in one transaction
+
+        Returns the ids of the new tasks by node ref.
+        """
+        nodes = _workflow_order(post_data.get("nodes", []))
+        if not nodes:
+            raise _views.RestAPIException(
+                "No nodes given",
+                _views.RESULT_ERROR,
+            )
+        with _views.dbsession(self.request) as session:
+            task_ids = _create_tasks(session, nodes)
+            session.commit()
+        return {
+            "result": _views.RESULT_OK,
+            "data": {
+                "ids": {
+                    node["ref"]: task_id
+                    for node, task_id in zip(nodes, task_ids)
+                },
+            },
+        }
+
+
 class TaskLogs(_views.BaseResource):
     NAME = "tasks/{task_id}/logs"
 
     @_views.get_all()
     @_views.with_model(output_model=_schemas.TaskLog, include=("worker",))
+    @_views.with_etag('task_log', 'workers')
     def get_task_log(self, task_id):
         with _views.dbsession(self.request) as session:
             task_logs = session.query(
@@ -291,10 +778,13 @@ class TaskChildren(_views.BaseResource):
 
     @_views.get_all()
     @_views.with_model(output_model=_schemas.Tasks, include=("worker", "script"))
+    @_views.with_etag(*_TASK_TABLES)
     def get_children(self, task_id):
         with _views.dbsession(self.request) as session:
             task = session.query(
                 _models.Task
+            ).options(
+                *_task_loads()
             ).get(task_id)
             if task is None:
                 raise _views.RestAPIException(
@@ -309,88 +799,519 @@ class TaskDepends(_views.BaseResource):
 
     @_views.get_all()
     @_views.with_model(output_model=_schemas.Tasks, include=("worker", "script"))
+    @_views.with_etag(*_TASK_TABLES)
     def get_depends(self, task_id):
         with _views.dbsession(self.request) as session:
-            task = session.query(
+            _check_task(session, task_id)
+            association = _models.association_table
+            return session.query(
                 _models.Task
-            ).get(task_id)
-            if task is None:
-                raise _views.RestAPIException(
-                    f"Task with id {task_id} not found",
-                    _views.RESULT_NOTFOUND
+            ).join(
+                association,
+                association.c.depend_id == _models.Task.id,
+            ).filter(
+                association.c.task_id == task_id
+            ).options(
+                *_task_loads()
+            ).all()
+
+
+# rows fetched from the server side cursor at once while exporting
+EXPORT_CHUNK = 1000
+EXPORT_COLUMNS = (
+    "id",
+    "title",
+    "state",
+    "script_id",
+    "script",
+    "team_id",
+    "worker_id",
+    "worker",
+    "parent_id",
+    "scheduled",
+    "run",
+    "scheduled_by",
+    "options",
+)
+
+
+def _parse_time(name, value):
+    if value is None:
+        return None
+    try:
+        return _dt.datetime.fromisoformat(value)
+    except ValueError:
+        raise _httpexceptions.HTTPBadRequest(
+            f"{name} must be an ISO 8601 date/time, got {value!r}"
+        )
+
+
+def _export_row(row):
+    """ exported task as dict of plain JSON types """
+    data = dict(zip(EXPORT_COLUMNS, row))
+    for name in ("scheduled", "run"):
+        if data[name] is not None:
+            data[name] = data[name].isoformat()
+    return data
+
+
+def _export_lines(engine, statement, format):
+    """ Encoded NDJSON or CSV lines of the statement's rows
+
+    The rows are read in chunks from a server side cursor on an own
+    connection, the request's session is closed when streaming starts.
+    """
+    connection = engine.connect().execution_options(stream_results=True)
+    try:
+        result = connection.execute(statement)
+        if format == "csv":
+            buffer = _io.StringIO()
+            writer = _csv.writer(buffer)
+            writer.writerow(EXPORT_COLUMNS)
+        while True:
+            rows = result.fetchmany(EXPORT_CHUNK)
+            if not rows:
+                break
+            if format == "csv":
+                for row in rows:
+                    data = _export_row(row)
+                    data["options"] = _json.dumps(data["options"])
+                    writer.writerow(data.values())
+                chunk = buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            else:
+                chunk = "".join(
+                    _json.dumps(_export_row(row)) + "\n" for row in rows
                 )
-            return task.depends
+            yield chunk.encode()
+        if format == "csv" and buffer.tell():
+            yield buffer.getvalue().encode()
+    finally:
+        connection.close()
+
+
+class TaskExport(_views.BaseResource):
+    NAME = "tasks/export"
+
+    @_views.get_all()
+    def export_tasks(
+            self,
+            format="ndjson",
+            state="ALL",
+            script=None,
+            worker=None,
+            team=None,
+            scheduled_from=None,
+            scheduled_to=None,
+            run_from=None,
+            run_to=None,
+            **unsupported
+    ):
+        """ stream all matching tasks (id asc) as NDJSON or CSV
+
+        Takes the filters of ``/tasks`` plus ``scheduled_from``,
+        ``scheduled_to``, ``run_from`` and ``run_to`` (ISO 8601, ``from``
+        inclusive, ``to`` exclusive). Memory use doesn't depend on the
+        number of rows. Everything matching is exported, page params
+        aren't supported.
+        """
+        if unsupported:
+            raise _httpexceptions.HTTPBadRequest(
+                f"Unsupported parameters {sorted(unsupported)}"
+            )
+        if format not in ("ndjson", "csv"):
+            raise _httpexceptions.HTTPBadRequest(
+                f"Unknown format {format!r}, use ndjson or csv"
+            )
+        task = _models.Task
+        ranges = (
+            (
+                task.scheduled,
+                _parse_time("scheduled_from", scheduled_from),
+                _parse_time("scheduled_to", scheduled_to),
+            ),
+            (
+                task.run,
+                _parse_time("run_from", run_from),
+                _parse_time("run_to", run_to),
+            ),
+        )
+        with _views.dbsession(self.request) as session:
+            query, _filtered = _filter_tasks(
+                session,
+                session.query(
+                    task.id,
+                    task.title,
+                    task.state,
+                    task.script_id,
+                    _models.Script.name,
+                    _models.Script.team_id,
+                    task.worker_id,
+                    _models.WorkerQueue.name,
+                    task.parent_id,
+                    task.scheduled,
+                    task.run,
+                    task.scheduled_by,
+                    task.options,
+                ).outerjoin(
+                    _models.Script,
+                    _models.Script.id == task.script_id,
+                ).outerjoin(
+                    _models.WorkerQueue,
+                    _models.WorkerQueue.id == task.worker_id,
+                ),
+                get_states(state),
+                script,
+                worker,
+                team,
+            )
+            for column, start, end in ranges:
+                if start is not None:
+                    query = query.filter(column >= start)
+                if end is not None:
+                    query = query.filter(column < end)
+            statement = query.order_by(task.id.asc()).statement
+
+        content_type, extension = {
+            "ndjson": ("application/x-ndjson", "ndjson"),
+            "csv": ("text/csv", "csv"),
+        }[format]
+        return _response.Response(
+            app_iter=_export_lines(
+                self.request.registry['dbsession_engine'],
+                statement,
+                format,
+            ),
+            content_type=content_type,
+            content_disposition=f"attachment; filename=tasks.{extension}",
+        )
+
+
+# longest time a request waits for a result, keeps web threads available
+MAX_RESULT_WAIT = 60
+# interval of keep alive comments in the result event stream
+EVENTS_KEEPALIVE = 15
+# longest time of an event stream or output follow, clients reconnect
+# (EventSource does it by itself)
+MAX_STREAM_TIME = 300
+
+
+def _busy():
+    """ all waiter slots taken, the client should come back later """
+    return _httpexceptions.HTTPServiceUnavailable(
+        "Too many clients waiting for tasks",
+        headers={"Retry-After": str(_views.WAITERS_RETRY_AFTER)},
+    )
+
+
+def _check_task(session, task_id):
+    """ raise if the task doesn't exist, else return its state """
+    row = session.query(
+        _models.Task.state
+    ).filter(
+        _models.Task.id == task_id
+    ).first()
+    if row is None:
+        raise _views.RestAPIException(
+            f"Task with id {task_id} not found",
+            _views.RESULT_NOTFOUND,
+        )
+    return row.state
+
+
+def _result_data(task_id):
+    state, result = _views.get_result(str(task_id))
+    if result is None:
+        result = (None, None, None)
+    return {
+        "state": state,
+        "ready": state in _celery_states.READY_STATES,
+        "return_code": result[0],
+        "stdout": result[1],
+        "stderr": result[2],
+    }
 
 
 class TaskResult(_views.BaseResource):
     NAME = "tasks/{task_id}/result"
 
     @_views.get_all()
-    def task_result(self, task_id):
+    def task_result(self, task_id, wait=None):
+        """ result of the task, returns immediately with the current state
+
+        With ``wait=<seconds>`` (at most MAX_RESULT_WAIT) the request
+        waits until the task finished (long poll). If too many clients
+        wait already, the current state is returned with status 202 and
+        Retry-After.
+        """
         with _views.dbsession(self.request) as session:
-            task = session.query(
-                _models.Task
-            ).get(task_id)
-            if task is None:
-                raise _views.RestAPIException(
-                    f"Task with id {task_id} not found",
-                    _views.RESULT_NOTFOUND,
+            _check_task(session, task_id)
+
+        data = _result_data(task_id)
+        if wait and not data["ready"]:
+            watcher = self.request.registry['result_watcher']
+            if watcher.acquire():
+                try:
+                    if watcher.wait(int(task_id), min(float(wait), MAX_RESULT_WAIT)):
+                        data = _result_data(task_id)
+                finally:
+                    watcher.release()
+            else:
+                self.request.response.status = 202
+                self.request.response.headers["Retry-After"] = str(
+                    _views.WAITERS_RETRY_AFTER
                 )
-            result = _views.get_result(str(task.id))
-            return {
-                "result": _views.RESULT_OK,
-                "data": {
-                    "return_code": result[0],
-                    "stdout": result[1],
-                    "stderr": result[2],
-                }
+        return {
+            "result": _views.RESULT_OK,
+            "data": data,
+        }
+
+
+class TaskResultEvents(_views.BaseResource):
+    NAME = "tasks/{task_id}/result/events"
+
+    @_views.get_all()
+    def task_result_events(self, task_id):
+        """ server-sent events stream, sends the result once finished
+
+        The stream ends after MAX_STREAM_TIME seconds, the client
+        reconnects. 503 with Retry-After if too many clients wait.
+        """
+        with _views.dbsession(self.request) as session:
+            _check_task(session, task_id)
+
+        watcher = self.request.registry['result_watcher']
+        if not watcher.acquire():
+            raise _busy()
+
+        def events():
+            finished = False
+            deadline = _time.monotonic() + MAX_STREAM_TIME
+            while True:
+                data = _result_data(task_id)
+                if data["ready"] or finished:
+                    # finished without result, e.g. deleted before it ran
+                    yield "event: result\ndata: {}\n\n".format(
+                        _json.dumps(data)
+                    ).encode()
+                    return
+                if _time.monotonic() >= deadline:
+                    yield b"retry: 1000\n\n"
+                    return
+                finished = watcher.wait(int(task_id), EVENTS_KEEPALIVE)
+                if not finished:
+                    yield b": keepalive\n\n"
+
+        return _response.Response(
+            app_iter=_views.ReleasingIter(events(), watcher.release),
+            content_type="text/event-stream",
+            cache_control="no-cache",
+        )
+
+
+# most bytes of output returned by one request
+MAX_OUTPUT_READ = 1024 * 1024
+# seconds between checks for new output while following a task
+FOLLOW_INTERVAL = 1
+
+
+class TaskOutput(_views.BaseResource):
+    NAME = "tasks/{task_id}/output"
+
+    @_views.get_all()
+    def task_output(self, task_id, stream="stdout", attempt=None, offset=0, length=None, tail=None, follow=None):
+        """ spooled output of a task run
+
+        Reads ``length`` bytes from ``offset`` or the last ``tail`` bytes
+        of ``stream`` (stdout or stderr) of run ``attempt`` (default: the
+        latest), at most MAX_OUTPUT_READ per request. ``size`` is the
+        current size of the output, continue reading at offset + length
+        of the returned data while ``running`` is true.
+
+        With ``follow=1`` the output is streamed as plain text from
+        ``offset`` until the task finished, at most MAX_STREAM_TIME
+        seconds. Continue at offset + received bytes if the task is
+        still running then. 503 with Retry-After if too many clients
+        wait.
+        """
+        with _views.dbsession(self.request) as session:
+            state = _check_task(session, task_id)
+        running = state not in _views.ResultWatcher.FINISHED
+        if stream not in _spool.STREAMS:
+            raise _httpexceptions.HTTPBadRequest(f"Unknown stream {stream!r}")
+        if attempt is not None:
+            attempt = int(attempt)
+
+        if follow:
+            watcher = self.request.registry['result_watcher']
+            if not watcher.acquire():
+                raise _busy()
+            return _response.Response(
+                app_iter=_views.ReleasingIter(
+                    self._follow(task_id, stream, attempt, int(offset)),
+                    watcher.release,
+                ),
+                content_type="text/plain",
+                charset="utf-8",
+                cache_control="no-cache",
+            )
+
+        length = min(int(length), MAX_OUTPUT_READ) if length else MAX_OUTPUT_READ
+        if tail is not None:
+            tail = min(int(tail), MAX_OUTPUT_READ)
+        output = _spool.read(
+            _views.SPOOL_DIR,
+            task_id,
+            stream=stream,
+            attempt=attempt,
+            offset=int(offset),
+            length=length,
+            tail=tail,
+        )
+        if output is None and not running:
+            raise _views.RestAPIException(
+                f"No output for task {task_id}",
+                _views.RESULT_NOTFOUND,
+            )
+        if output is None:
+            # not started yet
+            output = {
+                "attempt": attempt,
+                "offset": 0,
+                "size": 0,
+                "data": b"",
             }
+        data = output.pop("data")
+        return {
+            "result": _views.RESULT_OK,
+            "data": {
+                "task_id": int(task_id),
+                "stream": stream,
+                "running": running,
+                "length": len(data),
+                "output": data.decode('utf-8', errors='replace'),
+                **output,
+            },
+        }
+
+    def _follow(self, task_id, stream, attempt, offset):
+        """ yield new output as it is written until the task finished or
+        MAX_STREAM_TIME passed
+        """
+        watcher = self.request.registry['result_watcher']
+        finished = False
+        deadline = _time.monotonic() + MAX_STREAM_TIME
+        while True:
+            if attempt is None:
+                attempt = _spool.latest_attempt(_views.SPOOL_DIR, task_id)
+            output = None
+            if attempt is not None:
+                output = _spool.read(
+                    _views.SPOOL_DIR,
+                    task_id,
+                    stream=stream,
+                    attempt=attempt,
+                    offset=offset,
+                    length=MAX_OUTPUT_READ,
+                )
+            if output and output["data"]:
+                offset = output["offset"] + len(output["data"])
+                yield output["data"]
+                continue
+            if finished or _time.monotonic() >= deadline:
+                return
+            latest = _spool.latest_attempt(_views.SPOOL_DIR, task_id)
+            if attempt is not None and latest is not None and latest > attempt:
+                # the task is retried, this run is over
+                return
+            # wakes up early once the task finished, read what's left
+            finished = watcher.wait(int(task_id), FOLLOW_INTERVAL)
 
 
 class TaskState(_views.BaseResource):
     NAME = "tasks/state"
 
     @_views.get_all()
-    def tasks_state(self):
-        with _views.get_connection(self.request) as connection:
-            stmt = """
-            SELECT
-                state, count(1)
-            FROM
-                tasks
-            GROUP BY
-                state
-            """
-            result = {
-                "SUCCEED": 0,
-                "FAILED": 0,
-                "FAILED-ACKED": 0,
-                "PRERUN": 0,
-                "STARTED": 0,
-                "RETRIED": 0,
-                "ALL": 0,
-            }
-            cur = connection.cursor()
-            cur.execute(stmt)
-            db_result = dict(cur.fetchall())
-            result.update(db_result)
-            all_tasks = sum(db_result.values())
-            result["ALL"] = all_tasks
-            return {
-                "result": _views.RESULT_OK,
-                "data": {
-                    "type": "state",
-                    "attributes": {
-                        **result
-                    },
-                    "id": 1,
-                }
+    @_views.with_etag('tasks', 'scripts')
+    def tasks_state(self, worker_id=None, team_id=None):
+        """ number of tasks per state, optionally of one queue or team
+
+        Sums the task counter rows written by triggers on PostgreSQL,
+        other databases count the tasks. Only tasks in ``tasks`` are
+        counted: archived tasks and tasks removed by the retention job
+        are no longer part of the totals (SUCCEED, ALL, ...).
+        """
+        result = {
+            "SUCCEED": 0,
+            "FAILED": 0,
+            "FAILED-ACKED": 0,
+            "PRERUN": 0,
+            "STARTED": 0,
+            "RETRIED": 0,
+            "ALL": 0,
+        }
+        with _views.dbsession(self.request) as session:
+            if session.bind.dialect.name == 'postgresql':
+                counter = _models.TaskCounter
+                query = session.query(
+                    counter.state,
+                    _sa_core.func.sum(counter.count),
+                ).group_by(
+                    counter.state
+                )
+                if worker_id is not None:
+                    query = query.filter(counter.worker_id == int(worker_id))
+                if team_id is not None:
+                    query = query.filter(counter.team_id == int(team_id))
+            else:
+                query = session.query(
+                    _models.Task.state,
+                    _sa_core.func.count(_models.Task.id),
+                ).group_by(
+                    _models.Task.state
+                )
+                if worker_id is not None:
+                    query = query.filter(
+                        _models.Task.worker_id == int(worker_id)
+                    )
+                if team_id is not None:
+                    query = query.join(
+                        _models.Task.script
+                    ).filter(
+                        _models.Script.team_id == int(team_id)
+                    )
+            db_result = {state: int(count) for state, count in query}
+        result.update(db_result)
+        result["ALL"] = sum(db_result.values())
+        return {
+            "result": _views.RESULT_OK,
+            "data": {
+                "type": "state",
+                "attributes": {
+                    **result
+                },
+                "id": 1,
             }
+        }
 
 
 def includeme(config):
+    settings = config.get_settings()
+    config.registry['result_watcher'] = _views.ResultWatcher(
+        config.registry['dbsession_factory'],
+        max_waiters=int(settings.get(
+            'taskmanager.max_waiters',
+            _views.MAX_WAITERS,
+        )),
+    )
     TaskState.init_handler(config)
     TaskResult.init_handler(config)
+    TaskResultEvents.init_handler(config)
+    TaskOutput.init_handler(config)
+    TaskBatch.init_handler(config)
+    TaskWorkflow.init_handler(config)
+    TaskExport.init_handler(config)
     TaskChildren.init_handler(config)
     TaskDepends.init_handler(config)
     TaskLogs.init_handler(config)
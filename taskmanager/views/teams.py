@@ -15,6 +15,7 @@ class Teams(_views.BaseResource):
     @_views.get_all()
     @_views.with_model(output_model=_schemas.Team)
     @_views.with_links
+    @_views.with_etag('teams', max_age=_views.STATIC_MAX_AGE)
     def get_all(self, page=0, size=20):
         with _views.dbsession(self.request) as session:
             teams = session.query(
@@ -54,6 +55,7 @@ class Teams(_views.BaseResource):
 
     @_views.get_one(param='team_id')
     @_views.with_model(output_model=_schemas.Team)
+    @_views.with_etag('teams', max_age=_views.STATIC_MAX_AGE)
     def get_one(self, team_id):
         with _views.dbsession(self.request) as session:
             team = session.query(
@@ -107,6 +109,7 @@ class TeamName(_views.BaseResource):
     NAME = "teams/name"
 
     @_views.get_one(param="name")
+    @_views.with_etag('teams', max_age=_views.STATIC_MAX_AGE)
     def get_one(self, name):
         team_name = name
         with _views.dbsession(self.request) as session:
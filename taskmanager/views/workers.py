@@ -15,6 +15,7 @@ class Workers(_views.BaseResource):
     @_views.get_all()
     @_views.with_model(output_model=_schemas.Worker)
     @_views.with_links
+    @_views.with_etag('workers', 'worker_queues')
     def get(self, include_data=None, page=0, size=20):
         with _views.dbsession(self.request) as session:
             workers = session.query(
@@ -54,6 +55,7 @@ class Workers(_views.BaseResource):
 
     @_views.get_one(param="worker_id")
     @_views.with_model(output_model=_schemas.Worker)
+    @_views.with_etag('workers', 'worker_queues')
     def get_one(self, worker_id):
         with _views.dbsession(self.request) as session:
             worker = session.query(